@@ -0,0 +1,304 @@
+"""wrt-backup micro benchmarks
+
+Run from the repository root:
+
+    python -m benchmarks                         # Run all benchmarks
+    python -m benchmarks -k uci --quick          # Run a subset, skip big fixtures
+    python -m benchmarks --save baseline.json    # Save results
+    python -m benchmarks --compare baseline.json # Flag regressions, exit 1 if any
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import contextlib
+
+from benchmarks import fixtures
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name, quick=True):
+    "Register a benchmark, the decorated function returns (func, units, unit_name)"
+
+    def _decorator(setup):
+        BENCHMARKS[name] = (setup, quick)
+        return setup
+    return _decorator
+
+
+# Benchmarks definitions
+# ===============================
+
+def _uci_bench(size):
+    from wrt_backup.common import uci2dict
+
+    payload = fixtures.uci_show(size)
+    return (lambda: uci2dict(payload, native_type=True)), len(payload) / 1024 ** 2, "MB"
+
+
+@benchmark("uci2dict_10k")
+def bench_uci_10k(tmp):
+    return _uci_bench(10 * 1024)
+
+
+@benchmark("uci2dict_1m")
+def bench_uci_1m(tmp):
+    return _uci_bench(1024 ** 2)
+
+
+@benchmark("uci2dict_10m", quick=False)
+def bench_uci_10m(tmp):
+    return _uci_bench(10 * 1024 ** 2)
+
+
+@benchmark("uci2dict_stream_1m")
+def bench_uci_stream_1m(tmp):
+    from wrt_backup.common import uci2dict
+
+    payload = fixtures.uci_show(1024 ** 2)
+    func = lambda: uci2dict(io.StringIO(payload), native_type=True)
+    return func, len(payload) / 1024 ** 2, "MB"
+
+
+def _render_bench(fmt):
+    from wrt_backup.common import uci2dict
+    from wrt_backup.cli import render_output
+
+    payload = uci2dict(fixtures.uci_show(100 * 1024), native_type=True)
+    data = {f"router{idx}": payload for idx in range(4)}
+
+    def func():
+        with contextlib.redirect_stdout(io.StringIO()):
+            render_output(data, fmt=fmt)
+    return func, len(data), "hosts"
+
+
+@benchmark("render_json")
+def bench_render_json(tmp):
+    from wrt_backup.cli import OutputFormat
+    return _render_bench(OutputFormat.json)
+
+
+@benchmark("render_yaml")
+def bench_render_yaml(tmp):
+    from wrt_backup.cli import OutputFormat
+    return _render_bench(OutputFormat.yaml)
+
+
+def _inventory_bench(tmp, count):
+    from wrt_backup.app import MyApp
+
+    path = os.path.join(tmp, f"inventory_{count}")
+    fixtures.write_inventory(path, count)
+    return (lambda: MyApp(path=path)), count, "hosts"
+
+
+@benchmark("load_inventory_10")
+def bench_inventory_10(tmp):
+    return _inventory_bench(tmp, 10)
+
+
+@benchmark("load_inventory_1000")
+def bench_inventory_1000(tmp):
+    return _inventory_bench(tmp, 1000)
+
+
+@benchmark("load_inventory_10000", quick=False)
+def bench_inventory_10000(tmp):
+    return _inventory_bench(tmp, 10000)
+
+
+@benchmark("load_inventory_1000_cold")
+def bench_inventory_1000_cold(tmp):
+    from wrt_backup.app import MyApp
+
+    path = os.path.join(tmp, "inventory_1000_cold")
+    fixtures.write_inventory(path, 1000)
+
+    def func():
+        shutil.rmtree(os.path.join(path, ".cache"), ignore_errors=True)
+        MyApp(path=path)
+    return func, 1000, "hosts"
+
+
+@benchmark("load_inventory_split_1000")
+def bench_inventory_split(tmp):
+    from wrt_backup.app import MyApp
+
+    # One touched file out of 10, only this one is parsed again
+    path = os.path.join(tmp, "inventory_split_1000")
+    fixtures.write_inventory(path, 0)
+    for idx in range(10):
+        fixtures.write_inventory(os.path.join(path, "inventory.d"), 100,
+                                 name=f"{idx:02d}.yml", seed=idx, start=idx * 100)
+
+    def func():
+        with open(os.path.join(path, "inventory.d", "00.yml"), "a", encoding="utf-8") as _file:
+            _file.write("\n")
+        MyApp(path=path)
+    return func, 1000, "hosts"
+
+
+@benchmark("select_hosts_10000", quick=False)
+def bench_select_hosts(tmp):
+    from wrt_backup.app import MyApp
+
+    path = os.path.join(tmp, "select_10000")
+    fixtures.write_inventory(path, 10000)
+    app = MyApp(path=path)
+    app.selector.select("router1")
+
+    def func():
+        for _ in range(1000):
+            app.selector.select("router1,router5000,!router10")
+    return func, 1000, "selects"
+
+
+@benchmark("find_file_up")
+def bench_find_file_up(tmp):
+    from wrt_backup.common import list_parent_dirs, find_file_up
+
+    path = fixtures.deep_tree(os.path.join(tmp, "tree"), 30)
+    fixtures.write_inventory(os.path.join(tmp, "tree"), 1)
+
+    def func():
+        for _ in range(100):
+            find_file_up(["wrt-backup.yml"], list_parent_dirs(path))
+    return func, 100, "lookups"
+
+
+def _startup_bench(*args):
+    cmd = [sys.executable, "-m", "wrt_backup.cli", *args]
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+
+    def func():
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+    return func, 1, "runs"
+
+
+@benchmark("startup_version")
+def bench_startup_version(tmp):
+    return _startup_bench("--version")
+
+
+@benchmark("startup_hosts_1000")
+def bench_startup_hosts(tmp):
+    path = os.path.join(tmp, "startup_1000")
+    fixtures.write_inventory(path, 1000)
+    return _startup_bench("-c", path, "hosts", "-F", "json")
+
+
+@benchmark("startup_one_host_of_1000")
+def bench_startup_one_host(tmp):
+    path = os.path.join(tmp, "startup_one_1000")
+    fixtures.write_inventory(path, 1000)
+    return _startup_bench("-c", path, "archives", "list", "-l", "router999", "-F", "json")
+
+
+# Runner
+# ===============================
+
+def run_one(name, setup, tmp, repeat):
+    "Run a benchmark, return its result dict"
+
+    func, units, unit_name = setup(tmp)
+
+    # Warm up, then keep the best time
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+
+    # Memory is measured apart, tracemalloc slows things down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "time": best,
+        "throughput": units / best if best else 0,
+        "unit": f"{unit_name}/s",
+        "peak_mem": peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    "Return a list of regressions against baseline"
+
+    regressions = []
+    for name, res in results.items():
+        ref = baseline.get(name)
+        if not ref:
+            continue
+        for key in ["time", "peak_mem"]:
+            if ref[key] and res[key] > ref[key] * (1 + threshold):
+                ratio = res[key] / ref[key]
+                regressions.append(f"{name}: {key} is {ratio:.2f}x the baseline")
+    return regressions
+
+
+def main(argv=None):
+    "Run benchmarks"
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Run wrt-backup micro benchmarks")
+    parser.add_argument("-k", "--filter", default=None, help="Only run benchmarks containing this string")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of timed runs")
+    parser.add_argument("--quick", action="store_true", help="Skip big fixtures")
+    parser.add_argument("--save", default=None, help="Save results in json file")
+    parser.add_argument("--compare", default=None, help="Compare with results from json file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown considered as a regression")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as _file:
+            baseline = json.load(_file)
+
+    results = {}
+    tmp = tempfile.mkdtemp(prefix="wrt-backup-bench-")
+    try:
+        print(f"{'benchmark':<24} {'time':>10} {'throughput':>20} {'peak mem':>10} {'vs base':>8}")
+        for name, (setup, quick) in BENCHMARKS.items():
+            if args.filter and args.filter not in name:
+                continue
+            if args.quick and not quick:
+                continue
+
+            res = run_one(name, setup, tmp, args.repeat)
+            results[name] = res
+
+            ref = baseline.get(name, {}).get("time")
+            delta = f"{res['time'] / ref:.2f}x" if ref else "-"
+            print(f"{name:<24} {res['time'] * 1000:>8.2f}ms "
+                  f"{res['throughput']:>10.1f} {res['unit']:<9} "
+                  f"{res['peak_mem'] / 1024 ** 2:>8.1f}MB {delta:>8}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as _file:
+            json.dump(results, _file, indent=2)
+
+    regressions = compare(results, baseline, args.threshold)
+    for msg in regressions:
+        print(f"REGRESSION: {msg}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
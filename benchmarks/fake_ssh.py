@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Fake ssh client emulating OpenWrt routers
+
+It is installed as `ssh` in PATH by `benchmarks/fleet.py`. Remote commands
+are run locally with /bin/sh, with OpenWrt tools (uci, sysupgrade, ip ...)
+replaced by shims reading files from a per host fake root:
+
+    $WRT_FAKE_ROOT/<destination>/params.json   Latency and failure settings
+    $WRT_FAKE_ROOT/<destination>/etc/...        Router files
+    $WRT_FAKE_ROOT/shims/                       Commands shims
+
+Multiplexing is emulated with marker files at ControlPath.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import subprocess
+
+
+# Options taking an argument, see ssh(1)
+OPTS_WITH_ARG = set("BbcDEeFIiJLlmOopQRSWw")
+
+
+def parse_args(argv):
+    "Return (options, destination, command) from ssh argv"
+
+    opts = {"o": {}}
+    dest = None
+    cmd = []
+    idx = 0
+    while idx < len(argv):
+        arg = argv[idx]
+        if cmd or (dest and not arg.startswith('-')):
+            cmd.append(arg)
+        elif arg.startswith('-') and len(arg) > 1:
+            flag = arg[1]
+            if flag in OPTS_WITH_ARG:
+                val = arg[2:]
+                if not val:
+                    idx += 1
+                    val = argv[idx]
+                if flag == 'o':
+                    key, _, value = val.partition('=')
+                    opts["o"][key.lower()] = value
+                else:
+                    opts[flag] = val
+            else:
+                for char in arg[1:]:
+                    opts[char] = True
+        else:
+            dest = arg
+        idx += 1
+
+    return opts, dest, ' '.join(cmd)
+
+
+def control_path(opts, dest):
+    "Return the emulated control socket path, if multiplexing is enabled"
+
+    path = opts["o"].get("controlpath")
+    if not path or path == "none":
+        return None
+    digest = hashlib.sha1(f"{dest}{opts.get('p', '22')}{opts.get('l', '')}".encode()).hexdigest()
+    return path.replace("%C", digest)
+
+
+def main(argv):
+    "Emulate a ssh connection"
+
+    opts, dest, cmd = parse_args(argv)
+    root = os.path.join(os.environ["WRT_FAKE_ROOT"], dest or "")
+    params_file = os.path.join(root, "params.json")
+    if not dest or not os.path.isfile(params_file):
+        sys.stderr.write(f"ssh: Could not resolve hostname {dest}: Name or service not known\n")
+        return 255
+
+    with open(params_file, encoding="utf-8") as _file:
+        params = json.load(_file)
+
+    # Mux control commands
+    socket = control_path(opts, dest)
+    if "O" in opts:
+        if socket and os.path.exists(socket):
+            if opts["O"] == "exit":
+                os.unlink(socket)
+                sys.stderr.write("Exit request sent.\n")
+            return 0
+        sys.stderr.write(f"Control socket connect({socket}): No such file or directory\n")
+        return 255
+
+    # Connection setup
+    master = opts["o"].get("controlmaster", "no")
+    if socket and master in ("auto", "yes") and os.path.exists(socket):
+        time.sleep(params["latency"])
+    else:
+        time.sleep(params["latency"] + params["handshake"])
+        if random.random() < params["failure_rate"]:
+            sys.stderr.write(f"ssh: connect to host {dest} port 22: Connection timed out\n")
+            return 255
+        if socket and master in ("auto", "yes"):
+            os.makedirs(os.path.dirname(socket), exist_ok=True)
+            with open(socket, "w", encoding="utf-8"):
+                pass
+
+    if not cmd:
+        return 0
+
+    env = dict(os.environ)
+    env["FAKE_ROOT"] = root
+    env["PATH"] = os.path.join(os.environ["WRT_FAKE_ROOT"], "shims") + os.pathsep + env["PATH"]
+    return subprocess.call(["/bin/sh", "-c", cmd], env=env, cwd=root)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+"Synthetic fixtures for benchmarks"
+
+import os
+import random
+
+
+UCI_TEMPLATES = {
+    "dhcp_host": [
+        "dhcp.@host[{i}]=host",
+        "dhcp.@host[{i}].name='host-{i}'",
+        "dhcp.@host[{i}].mac='02:00:00:{a:02x}:{b:02x}:{c:02x}'",
+        "dhcp.@host[{i}].ip='10.{a}.{b}.{c}'",
+        "dhcp.@host[{i}].dns='1'",
+    ],
+    "fw_rule": [
+        "firewall.rule_{i}=rule",
+        "firewall.rule_{i}.name='Allow-{i}'",
+        "firewall.rule_{i}.src='wan'",
+        "firewall.rule_{i}.dest_port='{port}'",
+        "firewall.rule_{i}.proto='tcp' 'udp'",
+        "firewall.rule_{i}.target='ACCEPT'",
+    ],
+    "fw_redirect": [
+        "firewall.@redirect[{i}]=redirect",
+        "firewall.@redirect[{i}].name='It'\\''s redirect {i}'",
+        "firewall.@redirect[{i}].src_dport='{port}'",
+        "firewall.@redirect[{i}].dest_ip='192.168.{b}.{c}'",
+    ],
+}
+
+UCI_HEADER = """system.@system[0]=system
+system.@system[0].hostname='OpenWrt'
+system.@system[0].timezone='UTC'
+network.loopback=interface
+network.loopback.device='lo'
+network.loopback.proto='static'
+network.lan=interface
+network.lan.device='br-lan'
+network.lan.proto='static'
+network.lan.ipaddr='192.168.1.1'
+network.lan.netmask='255.255.255.0'
+network.lan.ip6assign='60'
+network.wan=interface
+network.wan.device='eth1'
+network.wan.proto='dhcp'
+dhcp.lan=dhcp
+dhcp.lan.interface='lan'
+dhcp.lan.start='100'
+dhcp.lan.limit='150'
+dhcp.lan.leasetime='12h'
+"""
+
+
+def uci_show(size, seed=0):
+    "Return a fake uci show output of about size bytes"
+
+    rnd = random.Random(seed)
+    lines = [UCI_HEADER]
+    counters = {name: 0 for name in UCI_TEMPLATES}
+    current = len(UCI_HEADER)
+    names = sorted(UCI_TEMPLATES)
+
+    while current < size:
+        name = rnd.choice(names)
+        i = counters[name]
+        counters[name] += 1
+        vals = {
+            "i": i,
+            "a": (i >> 16) & 0xff,
+            "b": (i >> 8) & 0xff,
+            "c": i & 0xff,
+            "port": 1024 + i % 60000,
+        }
+        for tpl in UCI_TEMPLATES[name]:
+            line = tpl.format(**vals) + "\n"
+            lines.append(line)
+            current += len(line)
+
+    return "".join(lines)
+
+
+def inventory(count, seed=0, start=0):
+    "Return a yaml inventory payload with count hosts, numbered from start"
+
+    rnd = random.Random(seed)
+    targets = [
+        ("ath79/generic", "ath79-generic-tplink_archer-c7-v2"),
+        ("ipq40xx/generic", "ipq40xx-generic-linksys_mr8300"),
+        ("ramips/mt7621", "ramips-mt7621-xiaomi_mi-router-4a-gigabit"),
+    ]
+    versions = ["21.02.7", "22.03.5", "23.05.2"]
+
+    out = ["settings:\n  ssh_multiplex: True\n", "inventory:\n"]
+    for idx in range(start, start + count):
+        target, device = rnd.choice(targets)
+        out.append(
+            f"  router{idx}:\n"
+            f"    host: 10.{(idx >> 16) & 0xff}.{(idx >> 8) & 0xff}.{idx & 0xff}\n"
+            f"    board_target: {target}\n"
+            f"    board_device: {device}\n"
+            f"    openwrt_version: {rnd.choice(versions)}\n"
+            f"    backup_all: {rnd.choice(['True', 'False'])}\n"
+            f"    backup_state: True\n"
+        )
+    return "".join(out)
+
+
+def write_inventory(path, count, name="wrt-backup.yml", seed=0, start=0):
+    "Write an inventory of count hosts in path, return the config file path"
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    cfg_file = os.path.join(path, name)
+    with open(cfg_file, "w", encoding="utf-8") as _file:
+        _file.write(inventory(count, seed=seed, start=start))
+    return cfg_file
+
+
+def deep_tree(root, depth):
+    "Create a directory tree of depth levels, return the deepest directory"
+
+    path = root
+    for idx in range(depth):
+        path = os.path.join(path, f"level{idx}")
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -0,0 +1,348 @@
+"""Simulated router fleet, for end to end throughput tests
+
+Run from the repository root:
+
+    python -m benchmarks.fleet --hosts 500 --jobs 32 --latency 0.05
+
+A fake `ssh` (benchmarks/fake_ssh.py) is put first in PATH, so Host.prepare
+uses it without any change. Each host gets a fake root with OpenWrt files,
+and a `wrt-backup backup` run is measured on the synthetic inventory.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tarfile
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks import fixtures
+
+
+PATH_SHIM = """#!/bin/sh
+# Rewrite router paths into the fake root
+for a do
+  shift
+  case "$a" in /etc/*|/proc/*) a="$FAKE_ROOT$a" ;; esac
+  set -- "$@" "$a"
+done
+{cmd} "$@"{post}
+"""
+
+SHIMS = {
+    "uci": """#!/bin/sh
+case "$1" in
+  show) if [ -n "$2" ]; then grep "^$2\\." "$FAKE_ROOT/uci_show"; else cat "$FAKE_ROOT/uci_show"; fi ;;
+  export) cat "$FAKE_ROOT/uci_export" ;;
+  *) echo "uci: unsupported command: $*" >&2; exit 1 ;;
+esac
+""",
+    "sysupgrade": """#!/bin/sh
+case " $* " in
+  *" -l "*) cat "$FAKE_ROOT/sysupgrade_list" ;;
+  *" -b "*) sleep "$(cat "$FAKE_ROOT/backup_delay")"; cat "$FAKE_ROOT/backup.tar.gz" ;;
+  *) echo "sysupgrade: unsupported command: $*" >&2; exit 1 ;;
+esac
+""",
+    "ip": """#!/bin/sh
+case "$1" in
+  a|addr) cat "$FAKE_ROOT/ip_addr" ;;
+  r|route) cat "$FAKE_ROOT/ip_route" ;;
+  *) echo "ip: unsupported command: $*" >&2; exit 1 ;;
+esac
+""",
+    "df": """#!/bin/sh
+cat "$FAKE_ROOT/df"
+""",
+    "opkg": """#!/bin/sh
+case "$1" in
+  list-installed) cat "$FAKE_ROOT/installed_packages" ;;
+  *) echo "opkg: unsupported command: $*" >&2; exit 1 ;;
+esac
+""",
+}
+
+PATH_SHIMS = {
+    "cat": "",
+    "ls": "",
+    "md5sum": ' | sed "s|$FAKE_ROOT||"',
+    "sha256sum": ' | sed "s|$FAKE_ROOT||"',
+}
+
+PACKAGES = ["base-files", "busybox", "dnsmasq", "dropbear", "firewall4", "luci", "odhcpd-ipv6only",
+            "opkg", "uci", "wpad-basic-mbedtls"]
+
+OS_RELEASE = """NAME="OpenWrt"
+VERSION="{version}"
+ID="openwrt"
+PRETTY_NAME="OpenWrt {version}"
+OPENWRT_BOARD="{target}"
+OPENWRT_ARCH="mips_24kc"
+OPENWRT_RELEASE="OpenWrt {version} r20134-5f15225c1e"
+"""
+
+DF = """Filesystem                Size      Used Available Use% Mounted on
+/dev/root                 3.0M      3.0M         0 100% /rom
+tmpfs                    60.6M    368.0K     60.3M   1% /tmp
+/dev/mtdblock4            9.3M      1.2M      8.1M  13% /overlay
+overlayfs:/overlay        9.3M      1.2M      8.1M  13% /
+"""
+
+IP_ROUTE = """default via 192.0.2.1 dev eth1 proto static src 192.0.2.10
+192.0.2.0/24 dev eth1 proto kernel scope link src 192.0.2.10
+192.168.1.0/24 dev br-lan proto kernel scope link src 192.168.1.1
+"""
+
+IP_ADDR = """1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN qlen 1000
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    inet 127.0.0.1/8 scope host lo
+2: br-lan: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc noqueue state UP qlen 1000
+    link/ether 02:00:00:00:00:01 brd ff:ff:ff:ff:ff:ff
+    inet 192.168.1.1/24 brd 192.168.1.255 scope global br-lan
+"""
+
+
+def uci_export(show):
+    "Convert a uci show output into uci export format"
+
+    packages = {}
+    for line in show.splitlines():
+        key, _, value = line.partition('=')
+        parts = key.split('.')
+        lines = packages.setdefault(parts[0], [])
+        if len(parts) == 2:
+            name = "" if parts[1].startswith('@') else f" '{parts[1]}'"
+            lines.append(f"\nconfig {value}{name}")
+        else:
+            lines.append(f"\toption {parts[2]} {value}")
+
+    return {pkg: "\n".join(lines).lstrip() + "\n\n" for pkg, lines in packages.items()}
+
+
+def build_variant(path, args, seed):
+    "Generate shared router payloads: uci outputs and backup archive"
+
+    os.makedirs(path)
+    rnd = random.Random(seed)
+    show = fixtures.uci_show(args.uci_size, seed=seed)
+    configs = uci_export(show)
+
+    with open(os.path.join(path, "uci_show"), "w", encoding="utf-8") as _file:
+        _file.write(show)
+    with open(os.path.join(path, "uci_export"), "w", encoding="utf-8") as _file:
+        _file.write("package " + "package ".join(f"{pkg}\n\n{cfg}" for pkg, cfg in configs.items()))
+
+    # Backup archive, padded with incompressible data to reach the target size
+    files = {f"etc/config/{pkg}": cfg.encode() for pkg, cfg in configs.items()}
+    files["etc/passwd"] = b"root:x:0:0:root:/root:/bin/ash\n"
+    fileobj = io.BytesIO()
+    with tarfile.open(fileobj=fileobj, mode="w:gz") as tar:
+        for name, payload in files.items():
+            _add_file(tar, name, payload)
+        padding = max(0, args.backup_size - len(fileobj.getvalue()))
+        _add_file(tar, "etc/dropbear/padding.bin", rnd.randbytes(padding))
+    with open(os.path.join(path, "backup.tar.gz"), "wb") as _file:
+        _file.write(fileobj.getvalue())
+
+    with open(os.path.join(path, "sysupgrade_list"), "w", encoding="utf-8") as _file:
+        _file.write("".join(f"/{name}\n" for name in sorted(files)))
+    with open(os.path.join(path, "installed_packages"), "w", encoding="utf-8") as _file:
+        _file.write("".join(f"{pkg} - 1.{rnd.randrange(10)}-1\n" for pkg in sorted(PACKAGES)))
+
+    # Also write router files, so path based commands work
+    for name, payload in files.items():
+        dest = os.path.join(path, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, "wb") as _file:
+            _file.write(payload)
+
+    return len(fileobj.getvalue())
+
+
+def _add_file(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    info.mtime = 1700000000
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def build_host(path, variant, name, conf, args, backup_size):
+    "Generate a router fake root"
+
+    os.makedirs(os.path.join(path, "etc"))
+    os.makedirs(os.path.join(path, "proc", "sys", "kernel"))
+
+    for item in ["uci_show", "uci_export", "backup.tar.gz", "sysupgrade_list", "installed_packages",
+                 "etc/config", "etc/passwd"]:
+        os.symlink(os.path.join(variant, item), os.path.join(path, item))
+
+    board = {
+        "model": {"id": conf["board_device"], "name": conf["board_device"]},
+        "network": {"lan": {"device": "br-lan", "protocol": "static"}},
+        "switch": {"switch0": {"enable": True}},
+    }
+    payloads = {
+        "params.json": json.dumps({
+            "latency": args.latency,
+            "handshake": args.handshake,
+            "failure_rate": args.failure_rate,
+        }),
+        "proc/sys/kernel/hostname": f"{name}\n",
+        "etc/board.json": json.dumps(board, indent=2),
+        "etc/os-release": OS_RELEASE.format(version=conf["openwrt_version"], target=conf["board_target"]),
+        "df": DF,
+        "ip_addr": IP_ADDR,
+        "ip_route": IP_ROUTE,
+        "backup_delay": f"{backup_size / args.bandwidth:.3f}",
+    }
+    for item, payload in payloads.items():
+        with open(os.path.join(path, item), "w", encoding="utf-8") as _file:
+            _file.write(payload)
+
+
+def build_fleet(tmp, args):
+    "Create the fake roots, shims and inventory, return the config dir"
+
+    from ruamel import yaml
+
+    fake_root = os.path.join(tmp, "fake")
+    config_dir = os.path.join(tmp, "config")
+    os.makedirs(config_dir)
+
+    # Shims
+    shims = os.path.join(fake_root, "shims")
+    os.makedirs(shims)
+    scripts = dict(SHIMS)
+    for cmd, post in PATH_SHIMS.items():
+        real = shutil.which(cmd)
+        scripts[cmd] = PATH_SHIM.format(cmd=real if post else f"exec {real}", post=post)
+    for cmd, script in scripts.items():
+        dest = os.path.join(shims, cmd)
+        with open(dest, "w", encoding="utf-8") as _file:
+            _file.write(script)
+        os.chmod(dest, 0o755)
+
+    # Fake ssh
+    bin_dir = os.path.join(tmp, "bin")
+    os.makedirs(bin_dir)
+    fake_ssh = os.path.join(bin_dir, "ssh")
+    with open(fake_ssh, "w", encoding="utf-8") as _file:
+        _file.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath(os.path.join(os.path.dirname(__file__), 'fake_ssh.py'))} \"$@\"\n")
+    os.chmod(fake_ssh, 0o755)
+
+    # Inventory and routers
+    cfg_file = fixtures.write_inventory(config_dir, args.hosts, seed=args.seed)
+    with open(cfg_file, encoding="utf-8") as _file:
+        inventory = yaml.safe_load(_file)["inventory"]
+
+    variants = []
+    for idx in range(args.variants):
+        path = os.path.join(fake_root, "variants", str(idx))
+        variants.append((path, build_variant(path, args, seed=args.seed + idx)))
+
+    for idx, (name, conf) in enumerate(inventory.items()):
+        variant, backup_size = variants[idx % len(variants)]
+        build_host(os.path.join(fake_root, conf["host"]), variant, name, conf, args, backup_size)
+
+    subprocess.run(["git", "init", "-q", config_dir], check=True)
+
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["WRT_FAKE_ROOT"] = fake_root
+    return config_dir
+
+
+def dir_size(path):
+    "Return the size of files in path"
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def run(args, config_dir):
+    "Run a fleet backup, return measures"
+
+    from wrt_backup.app import MyApp
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+
+    app = MyApp(path=config_dir, jobs=args.jobs)
+    app.cmd_backup()
+    app.close()
+
+    wall = time.monotonic() - start
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "hosts": args.hosts,
+        "jobs": args.jobs,
+        "failed": len(app.failed_hosts),
+        "wall_time": round(wall, 3),
+        "hosts_per_minute": round(args.hosts / wall * 60, 1),
+        "cpu_user": round(end_self.ru_utime - usage_self.ru_utime, 3),
+        "cpu_system": round(end_self.ru_stime - usage_self.ru_stime, 3),
+        "children_cpu_user": round(end_children.ru_utime - usage_children.ru_utime, 3),
+        "children_cpu_system": round(end_children.ru_stime - usage_children.ru_stime, 3),
+        "max_rss_kb": end_self.ru_maxrss,
+        "stored_bytes": dir_size(config_dir),
+    }
+
+
+def main(argv=None):
+    "Run a simulated fleet backup"
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fleet",
+                                     description="Backup a simulated router fleet")
+    parser.add_argument("--hosts", type=int, default=50, help="Number of routers")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Parallel jobs")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds of latency per ssh call")
+    parser.add_argument("--handshake", type=float, default=0.1, help="Seconds per ssh handshake")
+    parser.add_argument("--bandwidth", type=float, default=1024 ** 2, help="Backup transfer bytes/s")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Connection failure probability")
+    parser.add_argument("--uci-size", type=int, default=64 * 1024, help="Size of uci show outputs")
+    parser.add_argument("--backup-size", type=int, default=64 * 1024, help="Size of backup archives")
+    parser.add_argument("--variants", type=int, default=10, help="Number of distinct router payloads")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--runs", type=int, default=1, help="Number of successive backup runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated fleet directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show wrt-backup logs")
+    args = parser.parse_args(argv)
+
+    import logging
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger("sh").setLevel(logging.WARNING)
+
+    tmp = tempfile.mkdtemp(prefix="wrt-backup-fleet-")
+    try:
+        config_dir = build_fleet(tmp, args)
+        for idx in range(args.runs):
+            result = run(args, config_dir)
+            result["run"] = idx + 1
+            print(json.dumps(result))
+
+            # Commit results like users do, archives names have a second resolution
+            git = ["git", "-C", config_dir, "-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+            subprocess.run(git + ["add", "-A"], check=True)
+            subprocess.run(git + ["commit", "-q", "--allow-empty", "-m", f"Run {idx + 1}"], check=True)
+            time.sleep(1)
+    finally:
+        if args.keep:
+            print(f"Fleet kept in: {tmp}", file=sys.stderr)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""Local OpenWrt download mirror, for firmware download tests
+
+Run from the repository root:
+
+    python -m benchmarks.mirror --hosts 200 --jobs 16
+    python -m benchmarks.mirror --drop-after 100000 --runs 2   # Interrupt, then resume
+    python -m benchmarks.mirror --command show --runs 2        # Firmware index
+
+Images, sha256sums and profiles.json files are generated for the targets
+of a synthetic inventory, and served over HTTP/1.1 with keep-alive, Range
+and ETag support. The inventory `fw_mirror` setting points to the server.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from ruamel import yaml
+
+from benchmarks import fixtures
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    "Serve static files with keep-alive, Range and ETag support"
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] += 1
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+
+        path = os.path.join(server.root, self.path.split('?', 1)[0].lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, stat.st_size - 1
+        status = 200
+        ranges = self.headers.get("Range", "")
+        if ranges.startswith("bytes="):
+            first, _, last = ranges[6:].partition('-')
+            start = int(first)
+            end = int(last) if last else end
+            if start >= stat.st_size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.end_headers()
+        if not body:
+            return
+
+        # Cut the first transfer of each file to test resume
+        drop = None
+        if server.drop_after and path not in server.dropped:
+            server.dropped.add(path)
+            drop = server.drop_after
+
+        with open(path, "rb") as _file:
+            _file.seek(start)
+            sent = 0
+            while sent < length:
+                chunk = _file.read(min(64 * 1024, length - sent))
+                if drop is not None and sent + len(chunk) > drop:
+                    self.wfile.write(chunk[:max(drop - sent, 0)])
+                    self.close_connection = True
+                    with server.lock:
+                        server.stats["dropped"] += 1
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if server.bandwidth:
+                    time.sleep(len(chunk) / server.bandwidth)
+        with server.lock:
+            server.stats["bytes"] += sent
+
+
+def serve(root, drop_after=None, bandwidth=None):
+    "Start a mirror server in a thread, return it, its url is in server.url"
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.drop_after = drop_after
+    server.bandwidth = bandwidth
+    server.dropped = set()
+    server.lock = threading.Lock()
+    server.stats = {"connections": 0, "requests": 0, "bytes": 0, "dropped": 0}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_release(root, version, target, devices, image_size, seed=0):
+    "Write images, sha256sums and profiles.json of a release target"
+
+    rnd = random.Random(f"{seed}-{version}-{target}")
+    path = os.path.join(root, "releases", version, "targets", target)
+    os.makedirs(path, exist_ok=True)
+
+    sums = []
+    profiles = {}
+    for device in sorted(devices):
+        images = []
+        for image_type in ["factory", "sysupgrade"]:
+            name = f"openwrt-{version}-{device}-squashfs-{image_type}.bin"
+            payload = rnd.randbytes(image_size)
+            with open(os.path.join(path, name), "wb") as _file:
+                _file.write(payload)
+            digest = hashlib.sha256(payload).hexdigest()
+            sums.append(f"{digest} *{name}\n")
+            images.append({"type": image_type, "filesystem": "squashfs",
+                           "name": name, "sha256": digest})
+        profile = device[len(target.replace('/', '-')) + 1:]
+        profiles[profile] = {"device_packages": [], "images": images,
+                             "titles": [{"model": profile}]}
+
+    with open(os.path.join(path, "sha256sums"), "w", encoding="utf-8") as _file:
+        _file.writelines(sums)
+    with open(os.path.join(path, "profiles.json"), "w", encoding="utf-8") as _file:
+        json.dump({"profiles": profiles, "target": target, "version_number": version,
+                   "metadata_version": 1}, _file)
+
+
+def build_mirror(tmp, args):
+    "Generate the inventory and the mirror tree, return (config_dir, mirror_dir)"
+
+    config_dir = os.path.join(tmp, "config")
+    mirror_dir = os.path.join(tmp, "mirror")
+    fixtures.write_inventory(config_dir, args.hosts, seed=args.seed)
+
+    with open(os.path.join(config_dir, "wrt-backup.yml"), encoding="utf-8") as _file:
+        inventory = yaml.safe_load(_file)["inventory"]
+
+    releases = {}
+    for conf in inventory.values():
+        key = (conf["openwrt_version"], conf["board_target"])
+        releases.setdefault(key, set()).add(conf["board_device"])
+    for (version, target), devices in releases.items():
+        build_release(mirror_dir, version, target, devices, args.image_size, seed=args.seed)
+
+    return config_dir, mirror_dir
+
+
+def run(args, config_dir, server):
+    "Run fw_download on the inventory, return measures"
+
+    from wrt_backup.app import MyApp
+
+    before = dict(server.stats)
+    start = time.monotonic()
+
+    app = MyApp(path=config_dir, jobs=args.jobs)
+    if args.command == "show":
+        app.cmd_fw_show()
+    else:
+        app.cmd_fw_download()
+    app.close()
+
+    wall = time.monotonic() - start
+    ret = {
+        "hosts": args.hosts,
+        "jobs": args.jobs,
+        "failed": len(app.failed_hosts),
+        "wall_time": round(wall, 3),
+        "downloads": app.fw_cache.downloads,
+        "cache_hits": app.fw_cache.hits,
+    }
+    for key, value in server.stats.items():
+        ret[key] = value - before[key]
+    return ret
+
+
+def main(argv=None):
+    "Run firmware downloads against a local mirror"
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.mirror",
+                                     description="Download firmwares from a local mirror")
+    parser.add_argument("--hosts", type=int, default=50, help="Number of routers")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Parallel jobs")
+    parser.add_argument("--command", choices=["download", "show"], default="download",
+                        help="Run fw_download or fw_show")
+    parser.add_argument("--image-size", type=int, default=4 * 1024 ** 2, help="Size of images")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes/s per transfer")
+    parser.add_argument("--drop-after", type=int, default=None,
+                        help="Cut the first transfer of each file after this many bytes")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--runs", type=int, default=1, help="Number of successive runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show wrt-backup logs")
+    args = parser.parse_args(argv)
+
+    import logging
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    tmp = tempfile.mkdtemp(prefix="wrt-backup-mirror-")
+    try:
+        config_dir, mirror_dir = build_mirror(tmp, args)
+        server = serve(mirror_dir, drop_after=args.drop_after, bandwidth=args.bandwidth)
+
+        cfg_file = os.path.join(config_dir, "wrt-backup.yml")
+        with open(cfg_file, encoding="utf-8") as _file:
+            payload = _file.read()
+        with open(cfg_file, "w", encoding="utf-8") as _file:
+            _file.write(payload.replace("settings:\n", f"settings:\n  fw_mirror: {server.url}\n", 1))
+
+        for idx in range(args.runs):
+            result = run(args, config_dir, server)
+            result["run"] = idx + 1
+            print(json.dumps(result))
+        server.shutdown()
+    finally:
+        if args.keep:
+            print(f"Mirror kept in: {tmp}", file=sys.stderr)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,29 @@
 import os
-import json
-import sh
-import re
+import datetime
 import logging
-from ruamel import yaml
-
-from pprint import pprint
-
-from xdg import BaseDirectory
+import threading
+from functools import cached_property
 
 from wrt_backup.hosts import Host
-from wrt_backup.common import list_parent_dirs, find_file_up
+from wrt_backup.common import LazyModule, list_parent_dirs, find_file_up
+from wrt_backup.runner import run_hosts
+from wrt_backup.ssh import SSHMux
+from wrt_backup.cache import FactCache, FileCache
+from wrt_backup.archives import ArchiveStore, MANIFEST_EXT
+from wrt_backup.codec import DictionaryStore
+from wrt_backup.metrics import Metrics
+from wrt_backup import trace
+from wrt_backup.gitstatus import GitStatusIndex
+from wrt_backup.history import HistoryWriter
+from wrt_backup.selector import HostSelector
+from wrt_backup.firmware import FirmwareCache, FirmwareIndex, Downloader, parse_size, DEFAULT_MIRROR
 import wrt_backup.errors as error
 
 
+sh = LazyModule("sh")
+yaml = LazyModule("ruamel.yaml")
+BaseDirectory = LazyModule("xdg.BaseDirectory")
+
 logger = logging.getLogger(__name__)
 
 class MyApp:
@@ -25,22 +35,82 @@ class MyApp:
     app_name = 'wrt-backup'
     config_name = 'wrt-backup.yml'
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, jobs=None):
+
+        self.metrics = Metrics()
 
         # Load configuration
-        self.find_cfg(path)
-        self.read_cfg()
+        with trace.span("load_config", cat="app"):
+            self.find_cfg(path)
+            self.read_cfg()
+        self.ssh_mux = SSHMux(
+            self.get_cache_dir('ssh', create=False),
+            persist=self.settings.get('ssh_persist', 60),
+            enabled=self.settings.get('ssh_multiplex', True),
+            )
+        self.fact_cache = FactCache(
+            self.get_cache_dir('facts', create=False),
+            ttl=self.settings.get('facts_ttl', 3600),
+            )
+        self.fw_cache = FirmwareCache(
+            self.fw_path,
+            max_size=parse_size(self.settings.get('fw_cache_size', None)),
+            )
+        self.fw_mirror = self.settings.get('fw_mirror', DEFAULT_MIRROR)
+        self.downloader = Downloader(
+            pool_size=max(int(jobs or self.settings.get('jobs', 1)), 1),
+            timeout=self.settings.get('fw_timeout', 60),
+            )
+        self.fw_index = FirmwareIndex(
+            self.get_cache_dir('firmware-index', create=False),
+            self.downloader,
+            mirror=self.fw_mirror,
+            ttl=self.settings.get('fw_index_ttl', 86400),
+            )
+        self.archive_store = None
+        if self.settings.get('archive_store', False):
+            self.archive_store = self.get_archive_store()
+        self.archive_codec = self.settings.get('archive_codec', 'gzip')
+        if self.archive_codec not in ('gzip', 'zstd'):
+            raise error.InvalidConfig(f"Unsupported archive_codec: {self.archive_codec}")
+        if self.archive_store and self.archive_codec != 'gzip':
+            logger.warning("archive_codec is ignored when archive_store is enabled")
+        self.zstd_level = int(self.settings.get('zstd_level', 19))
+        self.dictionaries = DictionaryStore(os.path.join(self.config_dir, 'dictionaries'))
         self.build_host_cfg()
 
-    def read_cfg(self):
-        "Read yaml configuration file"
-
-        cfg_file = self.config_file
+        # Runtime settings, cli takes precedence over inventory
+        self.jobs = int(jobs or self.settings.get('jobs', 1))
+        self.failed_hosts = {}
+        self.history = None
+        self._git_status = None
+        self._git_lock = threading.Lock()
 
-        with open(cfg_file, encoding="utf-8") as _file:
-            payload = "".join(_file.readlines())
-
-        self.cfg_data = yaml.safe_load(payload)
+    def read_cfg(self):
+        "Read yaml configuration file, and inventory.d/ files"
+
+        try:
+            cache = FileCache(self.get_cache_dir('inventory'))
+        except OSError:
+            cache = FileCache(None)
+
+        self.cfg_data = cache.load(self.config_file, yaml.safe_load) or {}
+        self.settings = self.cfg_data.get('settings', None) or {}
+
+        # Inventory can be splitted in several files
+        inventory_dir = os.path.join(self.config_dir, 'inventory.d')
+        if os.path.isdir(inventory_dir):
+            inventory = dict(self.cfg_data.get('inventory', None) or {})
+            for name in sorted(os.listdir(inventory_dir)):
+                if not name.endswith(('.yml', '.yaml')):
+                    continue
+                path = os.path.join(inventory_dir, name)
+                data = cache.load(path, yaml.safe_load) or {}
+                for host, conf in (data.get('inventory', None) or {}).items():
+                    if host in inventory:
+                        raise error.InvalidConfig(f"Host {host} is defined twice, in {path}")
+                    inventory[host] = conf
+            self.cfg_data['inventory'] = inventory
 
     def find_cfg(self, path):
         "Search for project config file"
@@ -70,13 +140,83 @@ class MyApp:
         self.config_file = config_file
         self.fw_path = os.path.join(self.config_dir, "firmwares")
 
+    def get_cache_dir(self, *parts, create=True):
+        "Return a cache directory inside the config dir, ignored by git"
+
+        cache_dir = os.path.join(self.config_dir, '.cache')
+        path = os.path.join(cache_dir, *parts)
+        if create and not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+            ignore_file = os.path.join(cache_dir, '.gitignore')
+            if not os.path.isfile(ignore_file):
+                with open(ignore_file, "w", encoding="utf-8") as _file:
+                    _file.write("*\n")
+
+        return path
+
+    def get_archive_store(self):
+        "Return the deduplicated archive store"
+
+        return ArchiveStore(os.path.join(self.config_dir, 'store'))
+
+    def get_git_status(self):
+        "Return the git status index, taken once per run"
+
+        with self._git_lock:
+            if self._git_status is None:
+                with self.metrics.measure(None, "git_status"):
+                    self._git_status = GitStatusIndex(self.config_dir)
+        return self._git_status
+
+    def close(self):
+        "Release resources at the end of the run"
+
+        self.ssh_mux.close()
+        self.downloader.close()
+        if self.metrics.records or self.metrics.hosts:
+            self.metrics.write(self.get_cache_dir('metrics'),
+                               textfile_dir=self.settings.get('metrics_textfile_dir', None))
+
     def build_host_cfg(self):
-        "Build host configuration"
+        "Build host configuration, Host objects are created on first use"
 
-        self._hosts = []
+        self._hosts = {}
+        self.__dict__.pop('selector', None)
         self._inventory = self.cfg_data.get('inventory', {})
-        for name, conf in self._inventory.items():
-            self._hosts.append(Host(self, name, path=self.config_dir, **conf))
+
+    def get_host(self, name):
+        "Return the host of an inventory entry"
+
+        host = self._hosts.get(name)
+        if host is None:
+            with trace.span("host_init", cat="app", host=name):
+                host = Host(self, name, path=self.config_dir, **self._inventory[name])
+            self._hosts[name] = host
+        return host
+
+    @cached_property
+    def selector(self):
+        "Return the host selector, its indexes are built once per inventory"
+        return HostSelector(self._inventory, groups=self.cfg_data.get('groups'))
+
+    @cached_property
+    def ssh_cmd(self):
+        "Return the base ssh command, its environment is shared by hosts"
+
+        env = os.environ.copy()
+        env.update({
+                "WRT_BACKUP_DIR": self.config_dir,
+                "WRT_BACKUP_SSH_LOCAL": os.path.join(self.config_dir, 'ssh_local.d'),
+                })
+
+        ssh_args = []
+        ssh_config = os.path.join(self.config_dir, 'ssh_config')
+        if os.path.isfile(ssh_config):
+            logger.debug("Enable local ssh config: %s" , ssh_config)
+            ssh_args.extend(['-F', ssh_config])
+
+        return sh.ssh.bake(*ssh_args, _env=env)
 
 
     # Cli commands
@@ -85,72 +225,215 @@ class MyApp:
     def _loop_hosts(self, limit=None, log_msg=None):
         "Loop over hosts on limit"
 
-        for host in self._hosts:
-            if limit and host._name not in limit:
-                continue
+        names = self.selector.select(limit) if limit else self._inventory
+        for name in names:
+            host = self.get_host(name)
             if log_msg:
                 logger.info(log_msg.format(hostname = host._name, host = host))
             yield host
 
-    def cmd_backup(self, list_files=False, limit=None):
-        "Run backup on hosts"
+    def _run_hosts(self, func, limit=None, log_msg=None, on_result=None):
+        """
+        Run func on selected hosts in parallel, return results in inventory order.
+        With on_result, results are passed to on_result(name, result) as soon
+        as hosts are done instead, and None is returned
+        """
 
-        #for host in self._hosts:
-        #    if limit and host._name not in limit:
-        #        continue
+        ret = {}
+        hosts = self._loop_hosts(limit=limit)
+        ordered = on_result is None
+        for res in run_hosts(hosts, func, jobs=self.jobs, log_msg=log_msg, ordered=ordered):
+            self.metrics.host_done(res.name, res.duration, error=res.error)
+            if res.failed:
+                logger.error("Host %s failed after %.1fs: %s", res.name, res.duration, res.error)
+                self.failed_hosts[res.name] = res.error
+                continue
+            logger.debug("Host %s done in %.1fs", res.name, res.duration)
+            if on_result:
+                on_result(res.name, res.result)
+            else:
+                ret[res.name] = res.result
 
-        log_msg='Backuping device: {hostname}'
-        for host in self._loop_hosts(limit=limit, log_msg=log_msg):
-            host.cmd_backup(list_files=list_files)
+        return ret if ordered else None
+
+    def check_failures(self):
+        "Raise an error if some hosts failed during the run"
 
-    def cmd_uci_show(self, structured=True, native_type=False, limit=None):
+        if self.failed_hosts:
+            failed = ', '.join(self.failed_hosts.keys())
+            msg = f"{len(self.failed_hosts)} host(s) failed: {failed}"
+            raise error.HostsFailed(msg)
+
+    def cmd_backup(self, list_files=False, limit=None, force=False):
+        "Run backup on hosts"
+
+        log_msg='Backuping device: {hostname}'
+        if not list_files:
+            # Snapshot before any host writes in the repo
+            self.get_git_status()
+            if self.settings.get('git_history', False):
+                self.history = HistoryWriter(self.config_dir,
+                                             ref=self.settings.get('git_history_ref', None))
+
+        try:
+            ret = self._run_hosts(lambda host: host.cmd_backup(list_files=list_files, force=force),
+                                  limit=limit, log_msg=log_msg)
+        except BaseException:
+            if self.history:
+                self.history.abort()
+            raise
+
+        if self.history:
+            msg = f"Backup of {len(ret)} host(s)\n\nHosts: {', '.join(sorted(ret))}\n"
+            if self.failed_hosts:
+                msg += f"Failed: {', '.join(sorted(self.failed_hosts))}\n"
+            with self.metrics.measure(None, "history_commit"):
+                self.history.commit(msg)
+            self.history = None
+
+    def cmd_uci_show(self, structured=True, native_type=False, limit=None, on_result=None):
         "Show uci config on each hosts"
 
-        ret = {}
         log_msg='Get uci config for device: {hostname}'
-        for host in self._loop_hosts(limit=limit, log_msg=log_msg):
-        #for host in self._hosts:
-        #    if limit and host._name not in limit:
-        #        continue
-            ret[host._name] = host.uci_show(native_type=native_type, structured=structured)
-
-        return ret
+        return self._run_hosts(
+            lambda host: host.uci_show(native_type=native_type, structured=structured),
+            limit=limit, log_msg=log_msg, on_result=on_result)
 
-    def cmd_fw_download(self, limit=None, upgrade=True, version=None):
+    def cmd_fw_download(self, limit=None, upgrade=True, version=None, on_result=None):
         "Download firmware configuration"
 
-        ret = {}
         log_msg='Download firmware for device: {hostname}'
-        for host in self._loop_hosts(limit=limit, log_msg=log_msg):
-            ret[host._name] = host.fw_download(upgrade=upgrade, version=version)
+        ret = self._run_hosts(
+            lambda host: host.fw_download(upgrade=upgrade, version=version),
+            limit=limit, log_msg=log_msg, on_result=on_result)
+
+        cache = self.fw_cache
+        logger.info("Firmware cache: %s image(s) downloaded, %s served from cache",
+                    cache.downloads, cache.hits)
         return ret
 
 
-    def cmd_facts(self, limit=None):
+    def cmd_facts(self, limit=None, refresh=False, on_result=None):
         "Show device facts"
 
-        ret = {}
         log_msg='Get facts for device: {hostname}'
-        for host in self._loop_hosts(limit=limit, log_msg=log_msg):
-            ret[host._name] = host.cmd_show_facts()
-
+        return self._run_hosts(lambda host: host.get_facts(refresh=refresh),
+                               limit=limit, log_msg=log_msg, on_result=on_result)
+
+
+    def cmd_drift(self, limit=None, golden=None, on_result=None):
+        """
+        Show uci changes of devices since their last backup, or against a
+        golden template: a host name or a directory of uci files
+        """
+
+        reference = None
+        if golden:
+            if golden in self._inventory:
+                reference = os.path.join(self.get_host(golden).path, "config", "etc", "config")
+            elif os.path.isdir(os.path.join(golden, "etc", "config")):
+                reference = os.path.join(golden, "etc", "config")
+            else:
+                reference = golden
+            if not os.path.isdir(reference):
+                raise error.DriftError(f"Golden template not found: {reference}")
+
+        drifted = []
+
+        def _collect(name, result):
+            if result:
+                drifted.append(name)
+                if on_result:
+                    on_result(name, result)
+
+        log_msg='Check drift of device: {hostname}'
+        ret = self._run_hosts(lambda host: host.drift(reference=reference),
+                              limit=limit, log_msg=log_msg, on_result=_collect if on_result else None)
+        if ret is not None:
+            ret = {name: result for name, result in ret.items() if result}
+            drifted = list(ret)
+        logger.info("Drift: %s host(s) changed: %s", len(drifted), ', '.join(drifted))
         return ret
 
-
     def cmd_fw_show(self, limit=None):
         "Show firmware configuration"
 
         ret = {}
-        for host in self._hosts:
-            if limit and host._name not in limit:
-                continue
+        for host in self._loop_hosts(limit=limit):
             ret[host._name] = host.fw_show()
 
         return ret
 
+    def cmd_archive_list(self, limit=None):
+        "List hosts archives"
+
+        ret = {}
+        for host in self._loop_hosts(limit=limit):
+            ret[host._name] = host.list_archives()
+        return ret
+
+    def cmd_archive_restore(self, hostname, name, dest=None):
+        "Restore an host archive"
+
+        if hostname not in self._inventory:
+            raise error.ArchiveError(f"Unknown host: {hostname}")
+        return self.get_host(hostname).restore_archive(name, dest=dest)
+
+    def cmd_state_list(self, hostname):
+        "List state snapshots of an host"
+
+        if hostname not in self._inventory:
+            raise error.StateError(f"Unknown host: {hostname}")
+        return {hostname: self.get_host(hostname).list_states()}
+
+    def cmd_state_show(self, hostname, at=None, records=None):
+        "Show a state snapshot of an host, at is a date or a snapshot id"
+
+        if hostname not in self._inventory:
+            raise error.StateError(f"Unknown host: {hostname}")
+        if at:
+            try:
+                at = datetime.datetime.fromisoformat(at)
+            except ValueError:
+                pass
+        names = records.split(',') if records else None
+        return {hostname: self.get_host(hostname).show_state(at=at, names=names)}
+
+    def cmd_archive_import(self, limit=None):
+        "Move existing archives into the deduplicated store"
+
+        return self._run_hosts(lambda host: host.import_archives(), limit=limit,
+                               log_msg='Import archives of device: {hostname}')
+
+    def cmd_archive_train(self, limit=None, size=112640):
+        "Train a new zstd dictionary on the last archive of each host"
+
+        samples = []
+        for host in self._loop_hosts(limit=limit):
+            samples.extend(host.archive_samples())
+        return self.dictionaries.train(samples, size=size)
+
+    def cmd_archive_transcode(self, limit=None):
+        "Transcode archives to zstd with the current dictionary"
+
+        return self._run_hosts(lambda host: host.transcode_archives(), limit=limit,
+                               log_msg='Transcode archives of device: {hostname}')
+
+    def cmd_archive_stats(self, limit=None):
+        "Report deduplication stats of the archive store"
+
+        manifests = []
+        for host in self._loop_hosts(limit=limit):
+            path = os.path.join(host.path, "archives")
+            manifests.extend(os.path.join(path, name) for name in host.list_archives()
+                             if name.endswith(MANIFEST_EXT))
+        return self.get_archive_store().stats(manifests)
+
     def cmd_inventory(self, structured=True, native_type=False, limit=None):
         "Show host inventory"
 
+        if limit:
+            return {name: self._inventory[name] for name in self.selector.select(limit)}
         return self._inventory
 
 
@@ -0,0 +1,335 @@
+import os
+import gzip
+import json
+import zlib
+import time
+import base64
+import hashlib
+import logging
+import threading
+
+from wrt_backup.cache import write_json
+import wrt_backup.errors as error
+
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 512
+MANIFEST_EXT = ".manifest.json"
+
+# Tar entries whose content is stored as blobs: regular and contiguous files
+BLOB_TYPES = (b"0", b"\0", b"7")
+
+
+def tar_size(header):
+    "Return the size field of a tar header"
+
+    field = header[124:136]
+    if field[0] & 0x80:
+        # GNU base-256 encoding
+        return int.from_bytes(field[1:], "big")
+    field = field.split(b"\0", 1)[0].strip()
+    return int(field, 8) if field else 0
+
+
+class TarSplitter:
+    """
+    Split a tar stream into raw segments (headers, metadata) and
+    file content blobs, fed by chunks
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.segments = []
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._raw = bytearray()
+        self._state = "header"
+        self._remaining = 0
+        self._pad = 0
+        self._blob = None
+
+    def feed(self, data):
+        "Consume a chunk of the tar stream"
+
+        self._hash.update(data)
+        self.size += len(data)
+        self._buffer.extend(data)
+        self._process()
+
+    def _flush_raw(self):
+        if self._raw:
+            payload = base64.b64encode(zlib.compress(bytes(self._raw))).decode()
+            self.segments.append({"raw": payload, "size": len(self._raw)})
+            self._raw = bytearray()
+
+    def _process(self):
+        buf = self._buffer
+        while True:
+            if self._state == "header":
+                if len(buf) < BLOCK:
+                    return
+                header = bytes(buf[:BLOCK])
+                del buf[:BLOCK]
+                self._raw.extend(header)
+
+                # End of archive, keep the rest as is
+                if header == b"\0" * BLOCK:
+                    self._state = "trailer"
+                    continue
+
+                size = tar_size(header)
+                pad = -size % BLOCK
+                if header[156:157] in BLOB_TYPES and size:
+                    self._flush_raw()
+                    self._state = "blob"
+                    self._blob = bytearray()
+                    self._remaining = size
+                    self._pad = pad
+                elif size:
+                    self._state = "raw"
+                    self._remaining = size + pad
+
+            elif self._state == "blob":
+                if not buf:
+                    return
+                chunk = buf[:self._remaining]
+                del buf[:len(chunk)]
+                self._blob.extend(chunk)
+                self._remaining -= len(chunk)
+                if not self._remaining:
+                    self._state = "pad"
+                    self._remaining = self._pad
+
+            elif self._state == "pad":
+                if len(buf) < self._remaining:
+                    return
+                padding = bytes(buf[:self._remaining])
+                del buf[:self._remaining]
+                digest = self.store.put(bytes(self._blob))
+                segment = {"blob": digest, "size": len(self._blob), "pad": len(padding)}
+                if padding.strip(b"\0"):
+                    segment["padding"] = base64.b64encode(padding).decode()
+                self.segments.append(segment)
+                self._blob = None
+                self._state = "header"
+
+            elif self._state == "raw":
+                if not buf:
+                    return
+                chunk = buf[:self._remaining]
+                del buf[:len(chunk)]
+                self._raw.extend(chunk)
+                self._remaining -= len(chunk)
+                if not self._remaining:
+                    self._state = "header"
+
+            else: # trailer
+                self._raw.extend(buf)
+                del buf[:]
+                return
+
+    def close(self):
+        "Terminate the stream, return the manifest segments"
+
+        if self._state not in ("header", "trailer"):
+            raise error.ArchiveError("Truncated tar stream")
+        self._raw.extend(self._buffer)
+        self._buffer = bytearray()
+        self._flush_raw()
+        return self.segments
+
+    def hexdigest(self):
+        "Return the sha256 of the whole tar stream"
+        return self._hash.hexdigest()
+
+
+class GzipTee:
+    """
+    File-like reader over a gzip stream: compressed bytes are hashed
+    and copied to out, decompressed bytes are returned and fed to splitter.
+    The time spent waiting for the source is accounted in wait
+    """
+
+    def __init__(self, fileobj, out=None, splitter=None):
+        self.fileobj = fileobj
+        self.out = out
+        self.splitter = splitter
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.wait = 0.0
+        self._decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self._pending = bytearray()
+        self._eof = False
+
+    def _fill(self):
+        # Time blocked on the source is the transfer time
+        start = time.monotonic()
+        chunk = self.fileobj.read(64 * 1024)
+        self.wait += time.monotonic() - start
+        if not chunk:
+            self._eof = True
+            data = self._decomp.flush()
+        else:
+            self.hash.update(chunk)
+            self.size += len(chunk)
+            if self.out:
+                self.out.write(chunk)
+            data = self._decomp.decompress(chunk)
+
+            # Concatenated gzip members
+            while self._decomp.eof and self._decomp.unused_data:
+                rest = self._decomp.unused_data
+                self._decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                data += self._decomp.decompress(rest)
+
+        if data:
+            if self.splitter:
+                self.splitter.feed(data)
+            self._pending.extend(data)
+
+    def read(self, size=-1):
+        "Return up to size decompressed bytes"
+
+        while not self._eof and (size < 0 or len(self._pending) < size):
+            self._fill()
+
+        if size < 0:
+            size = len(self._pending)
+        ret = bytes(self._pending[:size])
+        del self._pending[:size]
+        return ret
+
+    def drain(self):
+        "Consume the remaining of the stream"
+
+        while not self._eof:
+            self._fill()
+            self._pending = bytearray()
+
+    def hexdigest(self):
+        "Return the sha256 of the compressed stream"
+        return self.hash.hexdigest()
+
+
+class ArchiveStore:
+    "Content addressed store of backup archives, blobs are shared between hosts"
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, payload):
+        "Store a blob, return its hash"
+
+        digest = hashlib.sha256(payload).hexdigest()
+        dest = self._object_path(digest)
+        if not os.path.isfile(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp_file = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "wb") as _file:
+                _file.write(zlib.compress(payload))
+            os.replace(tmp_file, dest)
+        return digest
+
+    def get(self, digest):
+        "Return a blob content"
+
+        try:
+            with open(self._object_path(digest), "rb") as _file:
+                return zlib.decompress(_file.read())
+        except FileNotFoundError as err:
+            raise error.ArchiveError(f"Missing blob in store: {digest}") from err
+
+    def splitter(self):
+        "Return a TarSplitter storing blobs in this store"
+        return TarSplitter(self)
+
+    def ingest(self, archive, manifest_file, **meta):
+        "Store a .tar.gz archive file, write its manifest"
+
+        splitter = self.splitter()
+        gz_hash = hashlib.sha256()
+        with open(archive, "rb") as _file:
+            gz_hash.update(_file.read())
+        with gzip.open(archive, "rb") as _file:
+            for chunk in iter(lambda: _file.read(64 * 1024), b""):
+                splitter.feed(chunk)
+
+        return self.write_manifest(manifest_file, splitter, gzip_sha256=gz_hash.hexdigest(), **meta)
+
+    def write_manifest(self, manifest_file, splitter, **meta):
+        "Write the manifest of a splitted tar stream"
+
+        manifest = {
+            "version": 1,
+            "tar_sha256": splitter.hexdigest(),
+            "tar_size": splitter.size,
+        }
+        manifest.update(meta)
+        manifest["segments"] = splitter.close()
+        write_json(manifest_file, manifest)
+        return manifest
+
+    def restore(self, manifest_file, dest):
+        "Rebuild an archive from its manifest, as .tar or .tar.gz depending dest"
+
+        with open(manifest_file, encoding="utf-8") as _file:
+            manifest = json.load(_file)
+
+        tar_hash = hashlib.sha256()
+        opener = gzip.GzipFile if dest.endswith(".gz") else None
+        with open(dest, "wb") as raw_file:
+            out = opener(fileobj=raw_file, mode="wb", mtime=0) if opener else raw_file
+            for segment in manifest["segments"]:
+                if "raw" in segment:
+                    chunk = zlib.decompress(base64.b64decode(segment["raw"]))
+                else:
+                    chunk = self.get(segment["blob"])
+                    if "padding" in segment:
+                        chunk += base64.b64decode(segment["padding"])
+                    else:
+                        chunk += b"\0" * segment["pad"]
+                tar_hash.update(chunk)
+                out.write(chunk)
+            if opener:
+                out.close()
+
+        if tar_hash.hexdigest() != manifest["tar_sha256"]:
+            raise error.ArchiveError(f"Restored archive checksum mismatch: {dest}")
+        return dest
+
+    def stats(self, manifests):
+        "Return deduplication stats of the store for the given manifests"
+
+        logical = 0
+        refs = set()
+        ref_count = 0
+        stored = 0
+        for manifest_file in manifests:
+            stored += os.path.getsize(manifest_file)
+            with open(manifest_file, encoding="utf-8") as _file:
+                manifest = json.load(_file)
+            logical += manifest["tar_size"]
+            for segment in manifest["segments"]:
+                if "blob" in segment:
+                    refs.add(segment["blob"])
+                    ref_count += 1
+
+        for digest in refs:
+            path = self._object_path(digest)
+            if os.path.isfile(path):
+                stored += os.path.getsize(path)
+
+        return {
+            "archives": len(manifests),
+            "blobs": len(refs),
+            "blob_references": ref_count,
+            "logical_bytes": logical,
+            "stored_bytes": stored,
+            "dedup_ratio": round(logical / stored, 2) if stored else None,
+        }
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_json(path, payload):
+    "Atomically write a json file"
+
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as _file:
+        json.dump(payload, _file, indent=2)
+    os.replace(tmp_file, path)
+
+
+class FactCache:
+    "On disk cache of hosts facts, one json file per host"
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.json")
+
+    def get(self, name, host=None, ttl=None):
+        "Return cached facts of a host, or None if missing or expired"
+
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            with open(self._file(name), encoding="utf-8") as _file:
+                entry = json.load(_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # Host address changed, facts may be from another device
+        if host and entry.get("host") != host:
+            logger.debug("Ignore cached facts of %s, host changed", name)
+            return None
+
+        age = time.time() - entry.get("timestamp", 0)
+        if ttl >= 0 and age > ttl:
+            logger.debug("Cached facts of %s are expired (%ds)", name, age)
+            return None
+
+        logger.debug("Use cached facts of %s (%ds old)", name, age)
+        return entry["facts"]
+
+    def set(self, name, host, facts):
+        "Store host facts in cache"
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+        entry = {
+            "name": name,
+            "host": host,
+            "timestamp": time.time(),
+            "facts": facts,
+        }
+        write_json(self._file(name), entry)
+
+
+class FileCache:
+    """
+    Cache of parsed files, as pickles. Entries are valid while the file
+    stat is unchanged, or when its content hash is the same.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, source):
+        digest = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()
+        return os.path.join(self.path, f"{digest}.pickle")
+
+    def load(self, source, parser):
+        "Return the parsed content of source, parser is called with the file content"
+
+        stat = os.stat(source)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        cache_file = self._file(source) if self.path else None
+
+        entry = None
+        if cache_file:
+            try:
+                with open(cache_file, "rb") as _file:
+                    entry = pickle.load(_file)
+            except (OSError, pickle.PickleError, EOFError, ValueError, AttributeError):
+                entry = None
+            if entry and entry.get("stat") == signature:
+                return entry["data"]
+
+        with open(source, "rb") as _file:
+            payload = _file.read()
+        digest = hashlib.sha256(payload).hexdigest()
+
+        if entry and entry.get("sha256") == digest:
+            logger.debug("File touched but unchanged: %s", source)
+            data = entry["data"]
+        else:
+            logger.debug("Parse file: %s", source)
+            data = parser(payload.decode("utf-8"))
+
+        if cache_file:
+            entry = {"stat": signature, "sha256": digest, "data": data}
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "wb") as _file:
+                    pickle.dump(entry, _file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, cache_file)
+            except OSError as err:
+                logger.debug("Can't write cache file %s: %s", cache_file, err)
+        return data
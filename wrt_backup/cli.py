@@ -32,7 +32,6 @@ from pprint import pprint
 from typing import Optional
 
 import json
-from ruamel import yaml
 import typer
 
 # import sh
@@ -40,8 +39,12 @@ import typer
 # from loguru import logger
 
 from wrt_backup.app import MyApp
+from wrt_backup.common import LazyModule
+from wrt_backup import trace
 from wrt_backup.errors import MyAppException
 
+yaml = LazyModule("ruamel.yaml")
+
 # Base Application example
 # ===============================
 
@@ -61,17 +64,54 @@ class OutputFormat(str, Enum):
     yaml = "yaml"
     json = "json"
     toml = "toml"
+    ndjson = "ndjson"
+    yaml_stream = "yaml-stream"
+
+
+STREAM_FORMATS = (OutputFormat.ndjson, OutputFormat.yaml_stream)
+
+
+def render_record(name, result, fmt=OutputFormat.ndjson):
+    "Print one host result as a single record, and flush it"
+    with trace.span("render", cat="render", host=name):
+        if fmt == OutputFormat.ndjson:
+            print (json.dumps({name: result}))
+        else:
+            print (yaml.dump({name: result}, default_flow_style=False, explicit_start=True), end='')
+        sys.stdout.flush()
+
+
+def stream_output(fmt):
+    "Return a callback printing host results as they come, or None if fmt is not a stream"
+    if fmt not in STREAM_FORMATS:
+        return None
+    return lambda name, result: render_record(name, result, fmt=fmt)
 
 
 def render_output(ret, fmt=OutputFormat.yaml):
-    if fmt == OutputFormat.yaml:
-        print (yaml.dump(ret, default_flow_style=False))
-    elif fmt == OutputFormat.python:
-        pprint (ret)
-    elif fmt == OutputFormat.json:
-        print (json.dumps(ret, indent=2))
-    else:
-        assert False, f"Unsuppored fmt: {fmt}"
+    if ret is None:
+        # Already streamed
+        return
+    if fmt in STREAM_FORMATS:
+        if not isinstance(ret, dict):
+            # Results not keyed by host are a single record
+            if fmt == OutputFormat.ndjson:
+                print (json.dumps(ret))
+            else:
+                print (yaml.dump(ret, default_flow_style=False, explicit_start=True), end='')
+            return
+        for name, result in ret.items():
+            render_record(name, result, fmt=fmt)
+        return
+    with trace.span("render", cat="render", format=fmt.value):
+        if fmt == OutputFormat.yaml:
+            print (yaml.dump(ret, default_flow_style=False))
+        elif fmt == OutputFormat.python:
+            pprint (ret)
+        elif fmt == OutputFormat.json:
+            print (json.dumps(ret, indent=2))
+        else:
+            assert False, f"Unsuppored fmt: {fmt}"
 
 
 # Core application definition
@@ -109,6 +149,24 @@ def main(
         "-V",
         help="Show version",
     ),
+    jobs: int = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        min=1,
+        help="Number of hosts to process in parallel (default: settings.jobs or 1)",
+    ),
+    trace_file: str = typer.Option(
+        None,
+        "--trace",
+        help="Write a Chrome/Perfetto trace of the run in this file",
+    ),
+    trace_sample: float = typer.Option(
+        0,
+        "--trace-sample",
+        min=0,
+        help="With --trace, sample python stacks of all threads every N milliseconds",
+    ),
 ):
     """
     MyApp Command Line Interface.
@@ -132,9 +190,15 @@ def main(
         print(__version__)
         return
 
+    if trace_file:
+        trace.start(trace_file, sample_interval=trace_sample / 1000 or None)
+        ctx.call_on_close(trace.stop)
+
     ctx.obj = {
-        "myapp": MyApp(path=working_dir),
+        "myapp": MyApp(path=working_dir, jobs=jobs),
     }
+    ctx.obj["myapp"].metrics.command = ctx.invoked_subcommand
+    ctx.call_on_close(ctx.obj["myapp"].close)
 
 
 # Simple commands example
@@ -157,6 +221,12 @@ def cli_backup(
         "-l",
         help="List files only",
     ),
+    force: bool = typer.Option(
+        False,
+        "--force",
+        "-f",
+        help="Backup devices even if they did not change",
+    ),
     ):
     """Backup router config"""
 
@@ -164,7 +234,8 @@ def cli_backup(
     # -------------------
     app = ctx.obj['myapp']
 
-    app.cmd_backup(list_files=list_files)
+    app.cmd_backup(list_files=list_files, force=force)
+    app.check_failures()
 
 
 @cli_app.command("show")
@@ -180,7 +251,7 @@ def cli_show(
         None,
         "--limit",
         "-l",
-        help="List of hosts to select",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
     ),
     structured: bool = typer.Option(
         True,
@@ -198,8 +269,10 @@ def cli_show(
     """Show uci export"""
 
     app = ctx.obj['myapp']
-    ret = app.cmd_uci_show(native_type=native_type, structured=structured, limit=limit)
+    ret = app.cmd_uci_show(native_type=native_type, structured=structured, limit=limit,
+                           on_result=stream_output(fmt))
     render_output(ret, fmt=fmt)
+    app.check_failures()
 
 
 @cli_app.command("fw_show")
@@ -215,7 +288,7 @@ def cli_fw_show(
         None,
         "--limit",
         "-l",
-        help="List of hosts to select",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
     ),
     ):
     """Show firmware info"""
@@ -237,7 +310,7 @@ def cli_fw_download(
         None,
         "--limit",
         "-l",
-        help="List of hosts to select",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
     ),
     release: str = typer.Option(
         None,
@@ -249,8 +322,9 @@ def cli_fw_download(
     """Download firmware"""
 
     app = ctx.obj['myapp']
-    ret = app.cmd_fw_download(limit=limit, version=release)
+    ret = app.cmd_fw_download(limit=limit, version=release, on_result=stream_output(fmt))
     render_output(ret, fmt=fmt)
+    app.check_failures()
 
 
 
@@ -263,10 +337,16 @@ def cli_hosts(
         "-F",
         help="Output format",
     ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
     ):
     """Show host inventory"""
     app = ctx.obj['myapp']
-    render_output(app.cmd_inventory(), fmt=fmt)
+    render_output(app.cmd_inventory(limit=limit), fmt=fmt)
 
 
 @cli_app.command("facts")
@@ -282,13 +362,242 @@ def cli_hosts(
         None,
         "--limit",
         "-l",
-        help="List of hosts to select",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        "-r",
+        help="Ignore cached facts and fetch them from devices",
     ),
     ):
     """Show hosts OS/Device facts"""
     app = ctx.obj['myapp']
-    render_output(app.cmd_facts(limit=limit), fmt=fmt)
+    ret = app.cmd_facts(limit=limit, refresh=refresh, on_result=stream_output(fmt))
+    render_output(ret, fmt=fmt)
+    app.check_failures()
+
+
+
+@cli_app.command("drift")
+def cli_drift(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    golden: str = typer.Option(
+        None,
+        "--golden",
+        "-g",
+        help="Compare with this host backup or directory of uci files, instead of the last backup",
+    ),
+    ):
+    """Show uci changes since last backup"""
+    app = ctx.obj['myapp']
+    ret = app.cmd_drift(limit=limit, golden=golden, on_result=stream_output(fmt))
+    render_output(ret, fmt=fmt)
+    app.check_failures()
+
+
+# Archives commands
+# ===============================
+cli_archives = typer.Typer(help="Manage backup archives")
+cli_app.add_typer(cli_archives, name="archives")
+
+
+@cli_archives.command("list")
+def cli_archives_list(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    ):
+    """List hosts archives"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_archive_list(limit=limit), fmt=fmt)
+
+
+@cli_archives.command("restore")
+def cli_archives_restore(
+    ctx: typer.Context,
+    host: str = typer.Argument(
+        ...,
+        help="Host name",
+    ),
+    name: str = typer.Argument(
+        ...,
+        help="Archive name, as shown by 'archives list'",
+    ),
+    dest: str = typer.Option(
+        None,
+        "--output",
+        "-o",
+        help="Destination file, .tar (default, exact payload) or .tar.gz (recompressed)",
+    ),
+    ):
+    """Restore an archive"""
+    app = ctx.obj['myapp']
+    print(app.cmd_archive_restore(host, name, dest=dest))
+
+
+@cli_archives.command("import")
+def cli_archives_import(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    ):
+    """Move .tar.gz archives into the deduplicated store"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_archive_import(limit=limit), fmt=fmt)
+    app.check_failures()
+
+
+@cli_archives.command("train")
+def cli_archives_train(
+    ctx: typer.Context,
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    size: int = typer.Option(
+        112640,
+        "--size",
+        "-s",
+        help="Dictionary size in bytes",
+    ),
+    ):
+    """Train a new zstd dictionary on the last archive of hosts"""
+    app = ctx.obj['myapp']
+    print(app.cmd_archive_train(limit=limit, size=size))
+
+
+@cli_archives.command("transcode")
+def cli_archives_transcode(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    ):
+    """Transcode archives to zstd with the current dictionary"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_archive_transcode(limit=limit), fmt=fmt)
+    app.check_failures()
+
+
+@cli_archives.command("stats")
+def cli_archives_stats(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    limit: str = typer.Option(
+        None,
+        "--limit",
+        "-l",
+        help="Hosts to select: names, globs, @group, key=value, !exclusion, comma separated",
+    ),
+    ):
+    """Show archive store deduplication stats"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_archive_stats(limit=limit), fmt=fmt)
+
 
+# State commands
+# ===============================
+cli_state = typer.Typer(help="Browse state snapshots")
+cli_app.add_typer(cli_state, name="state")
+
+
+@cli_state.command("list")
+def cli_state_list(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    host: str = typer.Argument(
+        ...,
+        help="Host name",
+    ),
+    ):
+    """List state snapshots"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_state_list(host), fmt=fmt)
+
+
+@cli_state.command("show")
+def cli_state_show(
+    ctx: typer.Context,
+    fmt: OutputFormat = typer.Option(
+        OutputFormat.yaml.value,
+        "--format",
+        "-F",
+        help="Output format",
+    ),
+    host: str = typer.Argument(
+        ...,
+        help="Host name",
+    ),
+    at: str = typer.Option(
+        None,
+        "--at",
+        "-a",
+        help="Show the last snapshot taken at or before this date (ISO format) or snapshot id",
+    ),
+    records: str = typer.Option(
+        None,
+        "--records",
+        "-r",
+        help="Comma separated records to show, like df,ip_route",
+    ),
+    ):
+    """Show a state snapshot"""
+    app = ctx.obj['myapp']
+    render_output(app.cmd_state_show(host, at=at, records=records), fmt=fmt)
 
 
 #@cli_app.command("logging")
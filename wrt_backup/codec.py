@@ -0,0 +1,206 @@
+import os
+import re
+import gzip
+import tarfile
+import hashlib
+import logging
+import threading
+
+from wrt_backup.common import LazyModule
+import wrt_backup.errors as error
+
+
+zstd = LazyModule("zstandard")
+
+logger = logging.getLogger(__name__)
+
+ZSTD_EXT = ".tar.zst"
+DICT_RGX = re.compile(r"^v(\d+)-(\d+)\.zdict$")
+CHUNK = 64 * 1024
+
+
+def require_zstd():
+    "Raise a clear error when the optional zstandard package is missing"
+
+    try:
+        return zstd.ZstdCompressor
+    except ImportError as err:
+        raise error.ArchiveError(
+            "The zstd codec needs the zstandard package, install wrt-backup[zstd]") from err
+
+
+class DictionaryStore:
+    """
+    Versioned zstd dictionaries trained on the fleet archives. Old versions
+    are kept, archives are decompressed with the dictionary of their frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._dicts = {}
+        self._lock = threading.Lock()
+
+    def list(self):
+        "Return dictionaries as a sorted list of (version, dict_id, file)"
+
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        ret = []
+        for name in names:
+            match = DICT_RGX.match(name)
+            if match:
+                ret.append((int(match.group(1)), int(match.group(2)), os.path.join(self.path, name)))
+        return sorted(ret)
+
+    def _load(self, dict_id, path):
+        with self._lock:
+            if dict_id not in self._dicts:
+                with open(path, "rb") as _file:
+                    self._dicts[dict_id] = zstd.ZstdCompressionDict(_file.read())
+            return self._dicts[dict_id]
+
+    def current(self):
+        "Return the last dictionary, or None"
+
+        dicts = self.list()
+        if not dicts:
+            return None
+        _, dict_id, path = dicts[-1]
+        return self._load(dict_id, path)
+
+    def get(self, dict_id):
+        "Return the dictionary of an id"
+
+        for _, _dict_id, path in self.list():
+            if _dict_id == dict_id:
+                return self._load(dict_id, path)
+        raise error.ArchiveError(f"Missing zstd dictionary {dict_id} in {self.path}")
+
+    def train(self, samples, size=112640):
+        "Train a new dictionary version from samples, return its file"
+
+        require_zstd()
+        samples = [sample for sample in samples if sample]
+        if len(samples) < 8:
+            raise error.ArchiveError(f"Not enough samples to train a dictionary: {len(samples)}")
+
+        trained = zstd.train_dictionary(size, samples)
+        dicts = self.list()
+        version = dicts[-1][0] + 1 if dicts else 1
+        os.makedirs(self.path, exist_ok=True)
+        dest = os.path.join(self.path, f"v{version:04d}-{trained.dict_id()}.zdict")
+        tmp_file = f"{dest}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as _file:
+            _file.write(trained.as_bytes())
+        os.replace(tmp_file, dest)
+        logger.info("Trained zstd dictionary %s on %s samples", os.path.basename(dest), len(samples))
+        return dest
+
+
+class ZstdWriter:
+    "Compress a tar stream fed by chunks into a file, hash the tar payload"
+
+    def __init__(self, fileobj, dictionary=None, level=19):
+        require_zstd()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        compressor = zstd.ZstdCompressor(level=level, dict_data=dictionary, write_checksum=True)
+        self._writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def feed(self, data):
+        "Compress a chunk"
+
+        self.hash.update(data)
+        self.size += len(data)
+        self._writer.write(data)
+
+    def close(self):
+        "Terminate the zstd frame, the file is left opened"
+        self._writer.close()
+
+    def hexdigest(self):
+        "Return the sha256 of the tar payload"
+        return self.hash.hexdigest()
+
+
+def frame_dict_id(header):
+    "Return the dictionary id of a zstd frame header, 0 without dictionary"
+
+    require_zstd()
+    return zstd.get_frame_parameters(header).dict_id
+
+
+def open_zstd(path, dictionaries):
+    "Return a reader of a .tar.zst file decompressed payload"
+
+    _file = open(path, "rb")
+    try:
+        dict_id = frame_dict_id(_file.read(18))
+        _file.seek(0)
+        dictionary = dictionaries.get(dict_id) if dict_id else None
+        return zstd.ZstdDecompressor(dict_data=dictionary).stream_reader(_file, closefd=True)
+    except BaseException:
+        _file.close()
+        raise
+
+
+def read_tar(path, dictionaries):
+    "Return a reader of the tar payload of a .tar.gz or .tar.zst archive"
+
+    if path.endswith(ZSTD_EXT):
+        return open_zstd(path, dictionaries)
+    return gzip.open(path, "rb")
+
+
+def transcode(src, dest, dictionaries, level=19):
+    "Write a .tar.zst copy of an archive with the current dictionary, return the tar sha256"
+
+    tmp_file = f"{dest}.part"
+    try:
+        with read_tar(src, dictionaries) as reader, open(tmp_file, "wb") as out:
+            writer = ZstdWriter(out, dictionary=dictionaries.current(), level=level)
+            for chunk in iter(lambda: reader.read(CHUNK), b""):
+                writer.feed(chunk)
+            writer.close()
+
+        # Only keep the copy once it can be read back
+        check = hashlib.sha256()
+        with open_zstd(tmp_file, dictionaries) as reader:
+            for chunk in iter(lambda: reader.read(CHUNK), b""):
+                check.update(chunk)
+        if check.hexdigest() != writer.hexdigest():
+            raise error.ArchiveError(f"Transcoded archive checksum mismatch: {src}")
+    except BaseException:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, dest)
+    return writer.hexdigest()
+
+
+def decompress(src, dest, dictionaries):
+    "Restore a .tar.zst archive as .tar or .tar.gz depending dest"
+
+    with open_zstd(src, dictionaries) as reader, open(dest, "wb") as raw_file:
+        out = gzip.GzipFile(fileobj=raw_file, mode="wb", mtime=0) if dest.endswith(".gz") else raw_file
+        for chunk in iter(lambda: reader.read(CHUNK), b""):
+            out.write(chunk)
+        if out is not raw_file:
+            out.close()
+    return dest
+
+
+def tar_samples(reader, limit=64):
+    "Return file contents of a tar stream, as dictionary training samples"
+
+    ret = []
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for member in tar:
+            if len(ret) >= limit:
+                break
+            if member.isfile() and 0 < member.size <= 128 * 1024:
+                ret.append(tar.extractfile(member).read())
+    return ret
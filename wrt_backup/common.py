@@ -1,8 +1,24 @@
 import os
 import re
+import importlib
 
 from pprint import pprint
 
+from wrt_backup import trace
+
+
+class LazyModule:
+    "Module proxy, the module is imported on first attribute access"
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
 
 def list_parent_dirs(path):
     """
@@ -48,77 +64,177 @@ def find_file_up(names, paths):
     return result
 
 
-def uci2dict(payload, native_type=True):
-    UCI_RGX = re.compile(r"^(?P<package>[^\.]+)\.((?P<new_section>[^\.=]+)|((?P<section_kind2>[^\.]+)\.(?P<name>[^\.=]+)))='?(?P<value>.*)'?$")
-
-    ret = {}
-    section_name = None
-    for line in payload.split('\n'):
-
-        m = UCI_RGX.match(line)
-        if not m:
-            continue
-        m = m.groupdict()
-
-        # Get name of the current scetion
-        package = m['package']
-        _section_name = m['new_section']
-        is_section = False
-        if _section_name:
-            is_section = True
-            section_name = _section_name
-            section_kind = m['value']
+# A value token is a sequence of quoted strings, escaped chars or bare words
+UCI_TOKEN_RGX = re.compile(r"(?:'[^']*'|\\.|[^\s'\\])+")
+UCI_PIECE_RGX = re.compile(r"'([^']*)'|\\(.)|([^\s'\\]+)")
 
 
-        # Create structure
-        if not package in ret:
-            ret[package] = {}
-
+def uci_unquote(value):
+    """
+    Decode a uci show value, return a string or a list
+    of strings for list options
+    """
 
-        # Reparse section type:
-        native_obj = 'dict'
+    # Fast path for simple quoted values
+    if len(value) > 1 and value[0] == "'" and value[-1] == "'" and "'" not in value[1:-1]:
+        return value[1:-1]
 
-        target = section_name
-        if not is_section:
-            target = m['section_kind2']
+    tokens = [
+        ''.join(a or b or c for a, b, c in UCI_PIECE_RGX.findall(token))
+        for token in UCI_TOKEN_RGX.findall(value)
+    ]
+    if len(tokens) == 1:
+        return tokens[0]
+    if not tokens:
+        return ''
+    return tokens
 
-        if target.startswith('@'):
-            tmp = re.match('@[^\[]+\[(?P<index>\d+)\]', target)
-            section_name = tmp.groupdict('index')['index']
-            if native_type:
-                native_obj = 'list'
 
+class UCIParser:
+    """
+    Incremental uci show parser, lines are consumed by chunks
+    so the whole output never need to be loaded in memory
+    """
 
-        # Handle container creation
-        if not section_kind in ret[package]:
-            if native_obj == 'dict':
-                ret[package][section_kind] = {}
+    chunk_size = 256 * 1024
+
+    def __init__(self, native_type=True):
+        self.native_type = native_type
+        self.result = {}
+        self._sections = {}
+        self._buffer = []
+        self._size = 0
+
+    def parse(self, lines):
+        "Consume an iterator of lines, return the resulting dict"
+
+        feed = self.feed
+        for line in lines:
+            feed(line)
+        self.flush()
+        return self.result
+
+    def parse_text(self, payload):
+        "Parse a whole uci show output string"
+
+        start = 0
+        while start < len(payload):
+            end = payload.find('\n', start + self.chunk_size)
+            end = len(payload) if end < 0 else end + 1
+            self._parse_chunk(payload[start:end])
+            start = end
+        return self.result
+
+    def feed(self, line):
+        "Queue a single uci show line"
+
+        self._buffer.append(line)
+        self._size += len(line)
+        if self._size > self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        "Parse queued lines"
+
+        if self._buffer:
+            chunk = '\n'.join(line.rstrip('\r\n') for line in self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._parse_chunk(chunk)
+
+    def _parse_chunk(self, chunk):
+        "Parse a block of complete lines"
+
+        sections = self._sections
+        get_section = self._get_section
+
+        for line in chunk.split('\n'):
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+
+            # Decode value, most of them are simple quoted strings
+            if value[:1] == "'" and value[-1:] == "'" and value.count("'") == 2:
+                value = value[1:-1]
+            elif "'" in value or '\\' in value or ' ' in value:
+                value = uci_unquote(value)
+
+            head, _, option = key.rpartition('.')
+            sect = sections.get(head)
+            if sect is None:
+                # Section declaration: package.section=kind
+                if head and '.' not in head:
+                    if option and isinstance(value, str):
+                        get_section(key, head, kind=value)
+                    continue
+
+                # Option of an undeclared section
+                package, _, section = head.partition('.')
+                if not section or '.' in section:
+                    continue
+                sect = get_section(head, package)
+                if sect is None:
+                    continue
+
+            # Option: package.section.option=value
+            # Repeated options are lists (add_list)
+            if option in sect:
+                prev = sect[option]
+                if not isinstance(prev, list):
+                    prev = sect[option] = [prev]
+                if isinstance(value, list):
+                    prev.extend(value)
+                else:
+                    prev.append(value)
             else:
-                ret[package][section_kind] = []
-
-
-        if native_obj == 'dict':
-
-            # Create container
-            if not section_name in ret[package][section_kind]:
-                ret[package][section_kind][section_name] = {}
-
-            # Assign values:
-            if not is_section:
-                ret[package][section_kind][section_name][m['name']] =  m['value']
-
-        else: # list
-            index = int(section_name)
-
-            # Create container
-            if not index < len(ret[package][section_kind]):
-                ret[package][section_kind].append({})
-
-            # Assign values:
-            if not is_section:
-                ret[package][section_kind][index][m['name']] =  m['value']
-
-    return ret
+                sect[option] = value
+
+    def _get_section(self, head, package, kind=None):
+        "Return the dict of a section, create it if missing"
+
+        sect = self._sections.get(head)
+        if sect is not None:
+            return sect
+        section = head[len(package) + 1:]
+
+        # Anonymous sections: @kind[index]
+        index = None
+        if section[0] == '@':
+            pos = section.find('[')
+            if pos < 0 or section[-1] != ']' or not section[pos + 1:-1].isdigit():
+                return None
+            kind = kind or section[1:pos]
+            index = int(section[pos + 1:-1])
+        if not kind:
+            return None
+
+        pkg = self.result.setdefault(package, {})
+        container = pkg.get(kind)
+
+        if index is not None and self.native_type and (container is None or isinstance(container, list)):
+            if container is None:
+                container = pkg[kind] = []
+            while len(container) <= index:
+                container.append({})
+            sect = container[index]
+        else:
+            if container is None:
+                container = pkg[kind] = {}
+            elif isinstance(container, list):
+                # Named section in a list of anonymous sections
+                container = pkg[kind] = {str(idx): val for idx, val in enumerate(container)}
+            name = section if index is None else str(index)
+            sect = container.setdefault(name, {})
+
+        self._sections[head] = sect
+        return sect
 
 
+def uci2dict(payload, native_type=True):
+    "Parse uci show output, payload can be a string or an iterator of lines"
 
+    parser = UCIParser(native_type=native_type)
+    with trace.span("uci2dict", cat="parse"):
+        if isinstance(payload, str):
+            return parser.parse_text(payload)
+        return parser.parse(payload)
@@ -0,0 +1,115 @@
+import os
+import re
+import shlex
+import hashlib
+import logging
+
+from wrt_backup.common import uci2dict
+
+
+logger = logging.getLogger(__name__)
+
+# Hash every uci package in one cheap command, on the router
+PROBE_CMD = "md5sum $(ls /etc/config | sed 's|^|/etc/config/|')"
+
+PACKAGE_RGX = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def parse_md5sums(payload):
+    "Parse md5sum output of /etc/config files, return {package: hash}"
+
+    ret = {}
+    for line in payload.splitlines():
+        digest, _, path = line.strip().partition(' ')
+        package = os.path.basename(path.strip().lstrip('*'))
+        if digest and PACKAGE_RGX.match(package):
+            ret[package] = digest
+    return ret
+
+
+def tree_of_dir(path):
+    "Return {package: hash} of uci files in path"
+
+    ret = {}
+    for package in os.listdir(path):
+        fpath = os.path.join(path, package)
+        if PACKAGE_RGX.match(package) and os.path.isfile(fpath):
+            with open(fpath, "rb") as _file:
+                ret[package] = hashlib.md5(_file.read()).hexdigest()
+    return ret
+
+
+def uci_quote(value):
+    "Quote a value like uci show does"
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def export2show(package, payload):
+    "Convert a uci config file into uci show lines"
+
+    counts = {}
+    section = None
+    for line in payload.splitlines():
+        # Tokenize like uci: quotes, escapes and trailing comments
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError:
+            logger.debug("Can't parse uci line of %s: %s", package, line)
+            continue
+        if not fields:
+            continue
+        keyword = fields[0]
+        if keyword == "config" and len(fields) >= 2:
+            kind = fields[1]
+            if len(fields) >= 3:
+                section = fields[2]
+            else:
+                section = f"@{kind}[{counts.get(kind, 0)}]"
+            counts[kind] = counts.get(kind, 0) + 1
+            yield f"{package}.{section}={kind}"
+        elif keyword in ("option", "list") and len(fields) >= 3 and section:
+            # Repeated options are parsed as lists, like add_list
+            yield f"{package}.{section}.{fields[1]}={uci_quote(fields[2])}"
+
+
+def sections(parsed):
+    "Flatten a parsed uci package, return {section: options}"
+
+    ret = {}
+    for kind, entries in parsed.items():
+        for name, options in entries.items():
+            label = f"@{kind}[{name}]" if name.isdigit() else name
+            ret[label] = dict(options, **{".type": kind})
+    return ret
+
+
+def load_package(path, package):
+    "Return the sections of a uci config file"
+
+    with open(os.path.join(path, package), encoding="utf-8", errors="replace") as _file:
+        lines = export2show(package, _file.read())
+        return sections(uci2dict(lines, native_type=False).get(package, {}))
+
+
+def diff_sections(old, new):
+    "Return added, removed and changed sections between two packages"
+
+    ret = {}
+    added = sorted(name for name in new if name not in old)
+    removed = sorted(name for name in old if name not in new)
+    changed = {}
+    for name in sorted(set(old) & set(new)):
+        if old[name] == new[name]:
+            continue
+        changed[name] = {
+            option: [old[name].get(option), new[name].get(option)]
+            for option in sorted(set(old[name]) | set(new[name]))
+            if old[name].get(option) != new[name].get(option)
+        }
+    if added:
+        ret["added"] = added
+    if removed:
+        ret["removed"] = removed
+    if changed:
+        ret["changed"] = changed
+    return ret
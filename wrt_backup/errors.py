@@ -13,3 +13,39 @@ class UncommitedWork(MyAppException):
 class MissingConfig(MyAppException):
     "Raised when configuration is not found"
     rc = 3
+
+class HostsFailed(MyAppException):
+    "Raised when one or more hosts failed"
+    rc = 4
+
+class RemoteCommandFailed(MyAppException):
+    "Raised when a command failed on the remote host"
+    rc = 5
+
+class ArchiveError(MyAppException):
+    "Raised when an archive can't be stored or restored"
+    rc = 6
+
+class HistoryError(MyAppException):
+    "Raised when backups can't be written in git history"
+    rc = 7
+
+class DownloadError(MyAppException):
+    "Raised when a firmware can't be downloaded"
+    rc = 8
+
+class InvalidConfig(MyAppException):
+    "Raised when configuration is not valid"
+    rc = 9
+
+class InvalidSelector(MyAppException):
+    "Raised when a host selector can't be resolved"
+    rc = 10
+
+class StateError(MyAppException):
+    "Raised when state snapshots can't be read"
+    rc = 11
+
+class DriftError(MyAppException):
+    "Raised when config drift can't be computed"
+    rc = 12
@@ -0,0 +1,489 @@
+import os
+import re
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from urllib.parse import urljoin, urlsplit
+
+from wrt_backup.common import LazyModule
+from wrt_backup.cache import write_json
+import wrt_backup.errors as error
+
+
+http_client = LazyModule("http.client")
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIRROR = "https://downloads.openwrt.org"
+CHUNK_SIZE = 256 * 1024
+MAX_REDIRECTS = 5
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    "Return a size in bytes from an int or a string like 2G"
+
+    if value is None or isinstance(value, int):
+        return value
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)i?B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise error.MyAppException(f"Invalid size: {value}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def image_name(version, device, image_type):
+    "Return the file name of an OpenWrt image"
+    return f"openwrt-{version}-{device}-squashfs-{image_type}.bin"
+
+
+def release_url(mirror, version, target):
+    "Return the url of a release target directory"
+    return f"{mirror.rstrip('/')}/releases/{version}/targets/{target}/"
+
+
+def parse_sha256sums(payload):
+    "Return a dict of file names and hashes from a sha256sums file"
+
+    ret = {}
+    for line in payload.splitlines():
+        digest, _, name = line.strip().partition(' ')
+        if digest and name:
+            ret[name.lstrip(' *')] = digest.lower()
+    return ret
+
+
+class FirmwareCache:
+    """
+    Firmware images shared between hosts, stored once per
+    (version, target, device, image type) in `<path>/<version>/<target>/`
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.downloads = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._used = set()
+
+    def image_path(self, version, target, device, image_type):
+        "Return the cache path of an image"
+        return os.path.join(self.path, version, target, image_name(version, device, image_type))
+
+    def _key_lock(self, path):
+        with self._lock:
+            return self._key_locks.setdefault(path, threading.Lock())
+
+    def get(self, key, fetch):
+        """
+        Return the cache path of an image, fetch(dest) is called to
+        download it when missing. Concurrent calls for a key wait for
+        the first download.
+        """
+
+        path = self.image_path(*key)
+        with self._lock:
+            self._used.add(path)
+
+        with self._key_lock(path):
+            if os.path.isfile(path):
+                self.hits += 1
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_file = f"{path}.part"
+                fetch(tmp_file)
+                os.replace(tmp_file, path)
+                self.downloads += 1
+
+        self.evict()
+        return path
+
+    def link(self, path, dest):
+        """
+        Make dest point to a cached image, hardlinked when possible.
+        Links are recorded in `<image>.links` to be removed with the image.
+        """
+
+        if os.path.lexists(dest):
+            if os.path.isfile(dest) and os.path.samefile(path, dest):
+                self._add_link(path, dest)
+                return dest
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            os.symlink(os.path.abspath(path), dest)
+        self._add_link(path, dest)
+        return dest
+
+    def _links(self, path):
+        try:
+            with open(f"{path}.links", encoding="utf-8") as _file:
+                return [line for line in _file.read().splitlines() if line]
+        except FileNotFoundError:
+            return []
+
+    def _add_link(self, path, dest):
+        dest = os.path.abspath(dest)
+        with self._lock:
+            if dest not in self._links(path):
+                with open(f"{path}.links", "a", encoding="utf-8") as _file:
+                    _file.write(f"{dest}\n")
+
+    def _remove_links(self, path):
+        "Remove host links of an image, the image is not freed while they exist"
+
+        for dest in self._links(path):
+            try:
+                if os.path.islink(dest):
+                    if os.path.realpath(dest) != os.path.realpath(path):
+                        continue
+                elif not os.path.samefile(path, dest):
+                    continue
+                os.remove(dest)
+                logger.debug("Remove firmware link: %s", dest)
+            except FileNotFoundError:
+                pass
+        if os.path.isfile(f"{path}.links"):
+            os.remove(f"{path}.links")
+
+    def list_images(self):
+        "Return (mtime, size, path) of cached images"
+
+        ret = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                ret.append((stat.st_mtime, stat.st_size, path))
+        return ret
+
+    def evict(self):
+        "Remove least recently used images above the size cap"
+
+        if not self.max_size:
+            return
+
+        with self._lock:
+            images = sorted(self.list_images())
+            total = sum(size for _, size, _ in images)
+            for _, size, path in images:
+                if total <= self.max_size:
+                    break
+                # Images of the current run are kept
+                if path in self._used:
+                    continue
+                logger.info("Evict firmware from cache: %s", path)
+                self._remove_links(path)
+                os.remove(path)
+                total -= size
+
+
+class Downloader:
+    """
+    Http(s) downloader keeping connections open between requests,
+    it can be shared between threads
+    """
+
+    def __init__(self, pool_size=4, timeout=60):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, origin):
+        with self._lock:
+            return self._pools.setdefault(origin, queue.LifoQueue(self.pool_size))
+
+    def _connect(self, origin, fresh=False):
+        if not fresh:
+            try:
+                return self._pool(origin).get_nowait()
+            except queue.Empty:
+                pass
+        scheme, netloc = origin
+        cls = http_client.HTTPSConnection if scheme == "https" else http_client.HTTPConnection
+        return cls(netloc, timeout=self.timeout)
+
+    def _release(self, origin, conn):
+        try:
+            self._pool(origin).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, url, headers=None, method="GET"):
+        """
+        Send a request, follow redirects, return (conn, origin, response),
+        the connection must be released once the response is read
+        """
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            origin = (parts.scheme, parts.netloc)
+            path = parts.path + (f"?{parts.query}" if parts.query else "")
+            conn = self._connect(origin)
+
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+            except (http_client.HTTPException, OSError):
+                # Pooled connections may have been closed by the server
+                conn.close()
+                conn = self._connect(origin, fresh=True)
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                self._release(origin, conn)
+                url = urljoin(url, resp.getheader("Location"))
+                logger.debug("Redirected to %s", url)
+                continue
+            return conn, origin, resp
+
+        raise error.DownloadError(f"Too many redirects for {url}")
+
+    def get(self, url, headers=None, method="GET"):
+        "Return the response and its body"
+
+        conn, origin, resp = self.request(url, headers=headers, method=method)
+        body = resp.read()
+        self._release(origin, conn)
+        return resp, body
+
+    def download(self, url, dest, sha256=None):
+        """
+        Download url in dest, resuming a partial dest file. The hash is
+        computed while streaming and checked against sha256 when known.
+        """
+
+        digest = hashlib.sha256()
+        offset = 0
+        headers = {}
+        if os.path.isfile(dest):
+            with open(dest, "rb") as _file:
+                for chunk in iter(lambda: _file.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    offset += len(chunk)
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+
+        logger.debug("Downloading url %s", url)
+        conn, origin, resp = self.request(url, headers=headers)
+        try:
+            if resp.status == 416 and offset:
+                # Partial file is complete, or bigger than the remote file
+                resp.read()
+            elif resp.status == 206 and offset:
+                logger.info("Resume download of %s at %s bytes", url, offset)
+                self._stream(resp, dest, "ab", digest)
+            elif resp.status == 200:
+                digest = hashlib.sha256()
+                self._stream(resp, dest, "wb", digest)
+            else:
+                resp.read()
+                raise error.DownloadError(f"Download failed with HTTP {resp.status}: {url}")
+        except (http_client.HTTPException, OSError) as err:
+            conn.close()
+            raise error.DownloadError(f"Download interrupted, it will resume on next run: {url}: {err}") from err
+        self._release(origin, conn)
+
+        if sha256 and digest.hexdigest() != sha256:
+            os.remove(dest)
+            raise error.DownloadError(f"Checksum mismatch for {url}: {digest.hexdigest()} != {sha256}")
+        return digest.hexdigest()
+
+    @staticmethod
+    def _stream(resp, dest, mode, digest):
+        size = 0
+        with open(dest, mode) as _file:
+            for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                _file.write(chunk)
+                size += len(chunk)
+
+        # Sized reads do not report truncated bodies
+        length = resp.getheader("Content-Length")
+        if length is not None and size < int(length):
+            raise http_client.IncompleteRead(b"", int(length) - size)
+
+    def close(self):
+        "Close pooled connections"
+
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            while not pool.empty():
+                pool.get_nowait().close()
+
+
+class FirmwareIndex:
+    """
+    On disk index of release targets metadata: profiles.json and
+    sha256sums are fetched once, then revalidated with their ETag
+    when older than ttl
+    """
+
+    files = ["profiles.json", "sha256sums"]
+
+    def __init__(self, path, downloader, mirror=DEFAULT_MIRROR, ttl=86400):
+        self.path = path
+        self.downloader = downloader
+        self.mirror = mirror
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._releases = {}
+
+    def _dir(self, version, target):
+        return os.path.join(self.path, version, target)
+
+    def _load_meta(self, path):
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as _file:
+                return json.load(_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _fetch(self, url, dest, meta):
+        "Fetch url in dest unless the cached copy is fresh, return its content or None"
+
+        entry = meta.get(url, {})
+        cached = os.path.isfile(dest)
+        age = time.time() - entry.get("timestamp", 0)
+        if entry and (cached or entry.get("status") == 404) and 0 <= age < self.ttl:
+            return self._read(dest)
+
+        headers = {}
+        if cached and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        elif cached and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            resp, body = self.downloader.get(url, headers=headers)
+        except (http_client.HTTPException, OSError) as err:
+            logger.warning("Can't refresh %s, using cached copy: %s", url, err)
+            return self._read(dest)
+
+        if resp.status == 304:
+            logger.debug("Firmware index entry not modified: %s", url)
+        elif resp.status == 200:
+            with open(dest, "wb") as _file:
+                _file.write(body)
+        elif resp.status == 404:
+            if cached:
+                os.remove(dest)
+        else:
+            logger.warning("Can't refresh %s (HTTP %s), using cached copy", url, resp.status)
+            return self._read(dest)
+
+        meta[url] = {
+            "status": 200 if resp.status == 304 else resp.status,
+            "etag": resp.getheader("ETag") or entry.get("etag"),
+            "last_modified": resp.getheader("Last-Modified") or entry.get("last_modified"),
+            "timestamp": time.time(),
+        }
+        return self._read(dest)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, encoding="utf-8") as _file:
+                return _file.read()
+        except FileNotFoundError:
+            return None
+
+    def release(self, version, target):
+        "Return the images of a release target, as a dict of names"
+
+        key = (version, target)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            if key in self._releases:
+                return self._releases[key]
+
+            path = self._dir(version, target)
+            os.makedirs(path, exist_ok=True)
+            meta = self._load_meta(path)
+            prefix = release_url(self.mirror, version, target)
+            urls = {name: urljoin(prefix, name) for name in self.files}
+            payloads = {name: self._fetch(url, os.path.join(path, name), meta)
+                        for name, url in urls.items()}
+
+            images = {}
+            for name, digest in parse_sha256sums(payloads["sha256sums"] or "").items():
+                images[name] = {"sha256": digest}
+            try:
+                profiles = json.loads(payloads["profiles.json"] or "{}").get("profiles", {})
+            except ValueError:
+                profiles = {}
+            for profile, conf in profiles.items():
+                for image in conf.get("images", []):
+                    entry = images.setdefault(image["name"], {})
+                    entry["profile"] = profile
+                    entry["sha256"] = image.get("sha256") or entry.get("sha256")
+
+            # Sizes need one HEAD request per image, release images never change
+            sizes = meta.setdefault("sizes", {})
+            for name, entry in images.items():
+                entry["size"] = sizes.get(name)
+
+            # The mirror answered 404 for every index file: the target does not exist
+            missing = all(meta.get(url, {}).get("status") == 404 for url in urls.values())
+            release = {
+                "available": payloads["sha256sums"] is not None or bool(profiles),
+                "missing": missing,
+                "images": images,
+                "meta": meta,
+                "path": path,
+            }
+            write_json(os.path.join(path, "meta.json"), meta)
+            self._releases[key] = release
+            return release
+
+    def image(self, version, target, name, size=False):
+        """
+        Return (available, info) of an image, info holds sha256 and size.
+        available is False if the release target is missing on the mirror,
+        None if its index can't be fetched
+        """
+
+        release = self.release(version, target)
+        if release["missing"]:
+            return False, {}
+        if not release["available"]:
+            return None, {}
+
+        info = release["images"].get(name)
+        if info is None:
+            return False, {}
+
+        if size and info.get("size") is None and not info.get("size_checked"):
+            url = release_url(self.mirror, version, target) + name
+            with self._lock:
+                lock = self._locks.setdefault((version, target, name), threading.Lock())
+            with lock:
+                if not info.get("size_checked"):
+                    info["size_checked"] = True
+                    try:
+                        resp, _ = self.downloader.get(url, method="HEAD")
+                        if resp.status == 200 and resp.getheader("Content-Length"):
+                            info["size"] = int(resp.getheader("Content-Length"))
+                    except (http_client.HTTPException, OSError) as err:
+                        logger.debug("Can't get size of %s: %s", url, err)
+                    if info.get("size") is not None:
+                        with self._lock:
+                            release["meta"]["sizes"][name] = info["size"]
+                            write_json(os.path.join(release["path"], "meta.json"), release["meta"])
+        return True, info
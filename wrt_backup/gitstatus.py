@@ -0,0 +1,102 @@
+import os
+import logging
+
+from wrt_backup.common import LazyModule
+
+
+sh = LazyModule("sh")
+
+logger = logging.getLogger(__name__)
+
+
+def parse_status(payload):
+    "Parse `git status --porcelain=v2 -z` output, return a list of (code, path)"
+
+    ret = []
+    records = iter(payload.split('\0'))
+    for record in records:
+        if not record or record.startswith('#'):
+            continue
+
+        kind = record[0]
+        if kind in ('?', '!'):
+            ret.append((kind, record[2:]))
+        elif kind == '1':
+            fields = record.split(' ', 8)
+            ret.append((fields[1], fields[8]))
+        elif kind == '2':
+            # Renames are followed by the original path
+            fields = record.split(' ', 9)
+            ret.append((fields[1], fields[9]))
+            next(records, None)
+        elif kind == 'u':
+            fields = record.split(' ', 10)
+            ret.append((fields[1], fields[10]))
+
+    return ret
+
+
+class GitStatusIndex:
+    "Snapshot of the repository status, indexed by directory"
+
+    def __init__(self, path):
+        self.path = path
+        self.toplevel = None
+        self.entries = []
+        self._dirs = {}
+        self._untracked_dirs = set()
+        self.load()
+
+    def load(self):
+        "Take the status snapshot of the repository holding path"
+
+        try:
+            out = sh.git("rev-parse", "--show-toplevel", _cwd=self.path, _tty_out=False)
+        except sh.ErrorReturnCode:
+            logger.warning("Not a git repository, skip git checks: %s", self.path)
+            return
+        self.toplevel = out.strip()
+
+        out = sh.git("status", "--porcelain=v2", "-z", _cwd=self.toplevel, _tty_out=False)
+        self.entries = parse_status(str(out))
+
+        for code, path in self.entries:
+            if code == '?' and path.endswith('/'):
+                self._untracked_dirs.add(path)
+
+            # Register the entry in all its parent directories
+            parts = path.rstrip('/').split('/')[:-1]
+            for idx in range(len(parts) + 1):
+                prefix = ''.join(f"{part}/" for part in parts[:idx])
+                self._dirs.setdefault(prefix, []).append((code, path))
+
+        logger.debug("Git status: %s entries in %s", len(self.entries), self.toplevel)
+
+    def _prefix(self, path):
+        rel = os.path.relpath(os.path.realpath(path), os.path.realpath(self.toplevel))
+        if rel == '.':
+            return ''
+        return rel.replace(os.sep, '/') + '/'
+
+    def lookup(self, path):
+        "Return (code, path) entries under path, paths are relative to toplevel"
+
+        if self.toplevel is None:
+            return []
+
+        prefix = self._prefix(path)
+        if prefix.startswith('../'):
+            return []
+        ret = list(self._dirs.get(prefix, []))
+
+        # Untracked parent directories are not expanded by git
+        parts = prefix.split('/')[:-1]
+        for idx in range(1, len(parts) + 1):
+            parent = ''.join(f"{part}/" for part in parts[:idx])
+            if parent in self._untracked_dirs:
+                ret.append(('?', parent))
+        return ret
+
+    def untracked(self, path):
+        "Return untracked files under path"
+        return [name for code, name in self.lookup(path) if code == '?']
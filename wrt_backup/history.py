@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import threading
+
+from wrt_backup.common import LazyModule
+import wrt_backup.errors as error
+
+
+sh = LazyModule("sh")
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """
+    Write backup results in git history with git fast-import, without
+    going through the index: blobs are streamed when hosts are done, and
+    one commit is created at the end of the run
+    """
+
+    def __init__(self, path, ref=None):
+        self.path = path
+        try:
+            self.toplevel = str(sh.git("rev-parse", "--show-toplevel",
+                                       _cwd=path, _tty_out=False)).strip()
+        except sh.ErrorReturnCode as err:
+            raise error.HistoryError(f"Not a git repository: {path}") from err
+        self.head_ref = self._head_ref()
+        self.ref = ref or self.head_ref
+        if not self.ref:
+            raise error.HistoryError("HEAD is detached, please set git_history_ref")
+        if not self.ref.startswith("refs/"):
+            self.ref = f"refs/heads/{self.ref}"
+
+        self.parent = self._rev_parse(self.ref)
+        self.hosts = {}
+        self._mark = 0
+        self._lock = threading.Lock()
+        self._proc = None
+        self._pipe = None
+
+    def _head_ref(self):
+        try:
+            out = sh.git("symbolic-ref", "-q", "HEAD", _cwd=self.toplevel, _tty_out=False)
+        except sh.ErrorReturnCode:
+            return None
+        return out.strip()
+
+    def _rev_parse(self, ref):
+        try:
+            out = sh.git("rev-parse", "--verify", "-q", f"{ref}^{{commit}}",
+                         _cwd=self.toplevel, _tty_out=False)
+        except sh.ErrorReturnCode:
+            return None
+        return out.strip()
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.toplevel).replace(os.sep, '/')
+
+    def start(self):
+        "Start git fast-import, it reads the stream from a pipe"
+
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, "rb") as pipe_in:
+            self._proc = sh.git("fast-import", "--quiet", "--done",
+                                _in=pipe_in, _cwd=self.toplevel,
+                                _bg=True, _bg_exc=False, _tty_out=False)
+        self._pipe = os.fdopen(write_fd, "wb")
+
+    def _write_blob(self, data):
+        self._mark += 1
+        self._pipe.write(b"blob\nmark :%d\ndata %d\n" % (self._mark, len(data)))
+        self._pipe.write(data)
+        self._pipe.write(b"\n")
+        return self._mark
+
+    def _add_file(self, path, files):
+        stat = os.lstat(path)
+        if os.path.islink(path):
+            mode, data = "120000", os.fsencode(os.readlink(path))
+        elif os.path.isfile(path):
+            mode = "100755" if stat.st_mode & 0o111 else "100644"
+            with open(path, "rb") as _file:
+                data = _file.read()
+        else:
+            return
+        files[self._relpath(path)] = (mode, self._write_blob(data))
+
+    def add_host(self, name, path, files=None, trees=None, deleted=None):
+        """
+        Stream host files into the repository, trees are directories
+        whose content replaces the previous one in history, deleted
+        paths are removed from it. Hosts with nothing to add are ignored.
+        """
+
+        files = [path for path in files or [] if path and os.path.lexists(path)]
+        trees = [tree for tree in trees or [] if os.path.isdir(tree)]
+        if not (files or trees or deleted):
+            logger.debug("History: nothing to add for %s", name)
+            return
+
+        entries = {}
+        with self._lock:
+            if self._proc is None:
+                self.start()
+
+            try:
+                self._add_host(entries, files, trees)
+            except BrokenPipeError:
+                self.close()
+                raise
+
+            self.hosts[name] = {
+                "path": self._relpath(path),
+                "trees": [self._relpath(tree) for tree in trees or []],
+                "deleted": [self._relpath(path) for path in deleted or []],
+                "files": entries,
+            }
+        logger.debug("History: %s files streamed for %s", len(entries), name)
+
+    def _add_host(self, entries, files, trees):
+        for tree in trees or []:
+            for root, dirs, names in os.walk(tree):
+                dirs.sort()
+                for fname in sorted(names + [d for d in dirs
+                                             if os.path.islink(os.path.join(root, d))]):
+                    self._add_file(os.path.join(root, fname), entries)
+        for path in files or []:
+            if path and os.path.lexists(path):
+                self._add_file(path, entries)
+
+    def _committer(self):
+        try:
+            return str(sh.git("var", "GIT_COMMITTER_IDENT",
+                              _cwd=self.toplevel, _tty_out=False)).strip()
+        except sh.ErrorReturnCode:
+            return f"wrt-backup <wrt-backup@localhost> {int(time.time())} +0000"
+
+    def commit(self, message):
+        "Create the run commit, return its hash or None if nothing was added"
+
+        if self._proc is None:
+            return None
+        if not self.hosts:
+            logger.info("History: nothing changed, no commit created")
+            self.abort()
+            return None
+
+        msg = message.encode()
+        pipe = self._pipe
+        pipe.write(b"commit %s\n" % self.ref.encode())
+        pipe.write(b"committer %s\n" % self._committer().encode())
+        pipe.write(b"data %d\n%s\n" % (len(msg), msg))
+        if self.parent:
+            pipe.write(b"from %s\n" % self.parent.encode())
+        for name in sorted(self.hosts):
+            host = self.hosts[name]
+            for tree in host["trees"] + host["deleted"]:
+                pipe.write(b'D "%s"\n' % _quote(tree))
+            for path, (mode, mark) in sorted(host["files"].items()):
+                pipe.write(b'M %s :%d "%s"\n' % (mode.encode(), mark, _quote(path)))
+        pipe.write(b"\ndone\n")
+        self.close()
+
+        commit = self._rev_parse(self.ref)
+        logger.info("History: commit %s on %s for %s hosts", commit[:10], self.ref, len(self.hosts))
+
+        # Refresh the index of committed paths, the working tree is already up to date
+        if self.ref == self.head_ref:
+            paths = sorted(host["path"] for host in self.hosts.values())
+            sh.git("reset", "-q", "--", *paths, _cwd=self.toplevel, _ok_code=[0, 1])
+        return commit
+
+    def close(self):
+        "Stop git fast-import, raise if it failed"
+
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            self._pipe.close()
+        except BrokenPipeError:
+            pass
+        try:
+            proc.wait()
+        except sh.ErrorReturnCode as err:
+            raise error.HistoryError(f"git fast-import failed: {err.stderr.decode().strip()}") from err
+
+    def abort(self):
+        "Stop git fast-import without creating the commit"
+
+        try:
+            self.close()
+        except error.HistoryError:
+            pass
+
+
+def _quote(path):
+    "Quote a path for fast-import"
+    return os.fsencode(path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
@@ -1,21 +1,57 @@
 import os
+import time
 import datetime
+from functools import cached_property
+import hashlib
 import json
-import sh
-import re
+import shutil
+import tarfile
 import logging
-from ruamel import yaml
 
-from pprint import pprint
-
-from xdg import BaseDirectory
-
-from wrt_backup.common import uci2dict
+from wrt_backup.common import LazyModule, uci2dict
+from wrt_backup.ssh import run_batch
+from wrt_backup.cache import write_json
+from wrt_backup.archives import MANIFEST_EXT, GzipTee
+from wrt_backup.codec import ZSTD_EXT, ZstdWriter, read_tar, tar_samples, transcode, decompress, frame_dict_id
+from wrt_backup.firmware import image_name, release_url
+from wrt_backup.states import StateStore
+from wrt_backup import trace
+from wrt_backup.drift import PROBE_CMD, parse_md5sums, tree_of_dir, load_package, sections, diff_sections
 import wrt_backup.errors as error
 
 
+sh = LazyModule("sh")
+
 logger = logging.getLogger(__name__)
 
+# State files written before snapshots were stored in states/
+LEGACY_STATE_FILES = ["state.md", "state.json"]
+
+# Installed packages, added to backups by sysupgrade -k
+PACKAGES_CMD = "if command -v opkg >/dev/null; then opkg list-installed; else apk list --installed; fi"
+
+# Extract like GNU tar does, when python supports extraction filters
+TAR_FILTER = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+
+def swap_dir(src, dest):
+    "Replace the dest directory by src, the previous dest is restored on failure"
+
+    old = f"{dest}.old"
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    if os.path.isdir(dest):
+        os.rename(dest, old)
+    try:
+        os.rename(src, dest)
+    except OSError:
+        if os.path.isdir(old):
+            os.rename(old, dest)
+        raise
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
 class Host:
     "This is a router class"
 
@@ -23,6 +59,7 @@ class Host:
                  host=None, port=None, user=None, path='.', 
                  backup_all=False, backup_state=False,
                  board_target = None, board_device = None, openwrt_version=None,
+                 groups=None,
                  ):
         
         self.app = app
@@ -39,6 +76,9 @@ class Host:
         self.board_device  =  board_device
         self.openwrt_version = openwrt_version
 
+        # Selection options
+        self.groups = groups or []
+
 
     def prepare(self, name, host=None, port=None, user=None):
         "Prepare host connection"
@@ -51,64 +91,120 @@ class Host:
         self._user = user
         self._port = port
 
-        ssh_args = [
-                self._host,
-        ]
+        ssh_args = self.app.ssh_mux.ssh_args()
+        ssh_args.append(self._host)
         if self._user:
             ssh_args.extend(["-l", self._user])
         if self._port:
             ssh_args.extend(["-p", self._port])
+        self._ssh_args = ssh_args
+
+    @cached_property
+    def _ssh(self):
+        "Ssh command of the host, built on first use"
+        return self.app.ssh_cmd.bake(*self._ssh_args)
+
+    def ssh_conn(self, *args, **kwargs):
+        """
+        Run a command on host, over the shared ssh connection. Foreground
+        commands are measured, background ones by their caller.
+        """
+
+        first = self.app.ssh_mux.register(self)
+        if kwargs.get('_bg') or kwargs.get('_iter'):
+            return self._ssh(*args, **kwargs)
+
+        # The first command of a host also pays the ssh handshake
+        command = ' '.join(str(arg) for arg in args)[:80]
+        with self.app.metrics.measure(self._name, "ssh", command=command, first=first) as record:
+            out = self._ssh(*args, **kwargs)
+            record["bytes"] = len(out) if isinstance(out, (str, bytes)) else 0
+            return out
+
+    def ssh_batch(self, cmds, check=False):
+        """
+        Run a dict of commands in a single ssh round trip, return
+        a dict of stdout, stderr and rc for each command
+        """
+
+        ret = run_batch(self.ssh_conn, cmds)
+        for name, res in ret.items():
+            self.app.metrics.add({"host": self._name, "phase": f"cmd:{name}",
+                                  "duration": res.get("duration", 0.0),
+                                  "bytes": len(res["stdout"]), "rc": res["rc"] or 0})
+
+        failed = [name for name, res in ret.items() if res["rc"] != 0]
+        missing = [name for name in cmds if name not in ret]
+        for name in failed:
+            logger.warning("Command '%s' failed on %s (rc=%s): %s",
+                           cmds[name], self._name, ret[name]["rc"], ret[name]["stderr"].strip())
+        if check and (failed or missing):
+            msg = f"Remote commands failed on {self._name}: {', '.join(failed + missing)}"
+            raise error.RemoteCommandFailed(msg)
 
-        env = os.environ.copy()
-        env.update({
-                "WRT_BACKUP_DIR": self.app.config_dir,
-                "WRT_BACKUP_SSH_LOCAL": os.path.join(self.app.config_dir, 'ssh_local.d'),
-                })
-
-        ssh_config = os.path.join(self.app.config_dir, 'ssh_config')
-        if os.path.isfile(ssh_config):
-            logger.debug("Enable local ssh config: %s" , ssh_config)
-            ssh_args.extend(['-F', ssh_config])
-
-        self.ssh_conn = sh.ssh.bake(*ssh_args, _env=env)
+        return ret
 
     def cmd_show_facts(self):
 
+        logger.debug("Get host facts")
+        cmds = {
+            "hostname": "cat /proc/sys/kernel/hostname",
+            "board": "cat /etc/board.json",
+            "release": "cat /etc/os-release",
+            }
+        out = self.ssh_batch(cmds, check=True)
+
         ret = {}
 
         # Fetch hostname
-        logger.debug("Get host fact")
-        cmd = "cat /proc/sys/kernel/hostname"
-        out = self.ssh_conn(cmd)
-        ret["hostname"] = str(out).strip()
+        ret["hostname"] = out["hostname"]["stdout"].strip()
 
         # Fetch hardware info
-        logger.debug("Get board fact")
-        cmd = "cat /etc/board.json"
-        out = self.ssh_conn(cmd)
-        payload = json.loads(out)
+        payload = json.loads(out["board"]["stdout"])
         if 'switch' in payload:
             del payload['switch']
         ret["board"] = payload
 
         # Fetch OS Info
-        logger.debug("Get OS facts")
-        cmd = "cat /etc/os-release"
-        lines = self.ssh_conn(cmd)
-        out = 'UNKNOWN'
-        for line in lines.split('\n'):
+        version = 'UNKNOWN'
+        target = None
+        for line in out["release"]["stdout"].split('\n'):
             if line.startswith('VERSION='):
                 parts = line.split('=', 1)
-                out = parts[1]
-                out = out.strip('"') # Strip quotes
+                version = parts[1]
+                version = version.strip('"') # Strip quotes
+            elif line.startswith('OPENWRT_BOARD='):
+                target = line.split('=', 1)[1].strip('"')
 
-        ret["version"] = out
+        ret["version"] = version
+        ret["target"] = target
 
         return ret
 
-    def cmd_backup_states(self, fmt="md"):
-        "Get command outputs"
+    def get_facts(self, refresh=False, cached=False):
+        """
+        Return host facts, from the fact cache when they are recent enough.
+        Only look into the cache if cached is True.
+        """
 
+        cache = self.app.fact_cache
+        if not refresh:
+            ret = cache.get(self._name, host=self._host)
+            if ret or cached:
+                return ret
+
+        ret = self.cmd_show_facts()
+        cache.set(self._name, self._host, ret)
+        return ret
+
+    @cached_property
+    def state_store(self):
+        "Return the store of state snapshots"
+        keyframe = self.app.settings.get('state_keyframe', 20)
+        return StateStore(os.path.join(self.path, "states"), keyframe=keyframe)
+
+    def cmd_backup_states(self):
+        "Snapshot command outputs, return the new snapshot file or None if unchanged"
 
         cmds = {
                 #"uptime": "uptime",
@@ -127,64 +223,98 @@ class Host:
                 "uci_show": "uci show",
             }
 
-        ret = {}
-        for name, cmd in cmds.items():
-            out = self.ssh_conn(cmd)
-            ret[name] = out
-
+        out = self.ssh_batch(cmds)
+        records = {}
+        for name, res in out.items():
+            records[name] = {"stdout": res["stdout"]}
+            if res["rc"] != 0:
+                records[name]["rc"] = res["rc"]
 
         # Loop for switch config
         # TODO
 
+        dest_file = self.state_store.write(records, self.date_now)
+        if dest_file:
+            logger.info("Created state snapshot: %s", dest_file)
+        return dest_file
+
+    def remove_legacy_states(self):
+        "Remove state files of older versions once snapshots exist, return their paths"
+
+        if not self.state_store.list():
+            return []
+        ret = []
+        for name in LEGACY_STATE_FILES:
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                os.remove(path)
+                logger.info("Removed legacy state file: %s", path)
+                ret.append(path)
+        return ret
 
-        if fmt == 'json':
-            # Save results
-            dest_file = os.path.join(self.path, "state.json")
-            out_file = open(dest_file, "w")
-            json.dump(ret, out_file, indent = 4)
-            out_file.close()
-        else:
-            dest_file = os.path.join(self.path, "state.md")
-            str_out = [f"# Configuration for {self._name}/{self._host}\n"]
-            for name, output in ret.items():
-                str_out.append(f"\n## {name}\n\n")
-                str_out.append("```")
-                str_out.append(output)
-                str_out.append("```")
-
-            str_out = '\n'.join(str_out) + '\n'
-
-            out_file = open(dest_file, "w")
-            out_file.write(str_out)
-            out_file.close()
-
-        logger.info ("Created state file: %s", dest_file)
+    def show_state(self, at=None, names=None):
+        "Return a state snapshot, the last one taken at or before at"
+        return self.state_store.show(at=at, names=names)
 
+    def list_states(self):
+        "List state snapshots"
+        return [{"id": snap_id, "full": full} for snap_id, full in self.state_store.list()]
 
 
     def check_git_status(self):
         "Check if git is in a correct state"
-        target = self.path
-
-        states = sh.git("status", "--porcelain", ".", _cwd=target)
 
         failed = []
-        for state in states.split('\n'):
-            splitted = state.split(' ',2)
-
-            if len(splitted) < 2:
-                continue
-
-            opts = splitted[0]
-            file = splitted[1]
-            if opts.startswith('?'):
-                failed.append(f"Please add, commit or remove from git file: {file}")
+        for file in self.app.get_git_status().untracked(self.path):
+            failed.append(f"Please add, commit or remove from git file: {file}")
 
         if failed:
             msg = "Some errors has been discovered:\n" + '\n'.join(failed)
             raise error.UncommitedWork(msg)
 
-    def cmd_backup(self, list_files=False):
+    def backup_fingerprint(self):
+        """
+        Return a hash of the backup file list, their content and the
+        installed packages, computed on the device, or None if it can't
+        be computed
+        """
+
+        list_cmd = "sysupgrade -l -o" if self.backup_all else "sysupgrade -l"
+        cmds = {
+            # File names are NUL separated, they may contain spaces
+            "files": f"{list_cmd} | sort | tr '\\n' '\\0' | xargs -0 sha256sum",
+            "packages": f"{PACKAGES_CMD} | sort",
+        }
+        out = self.ssh_batch(cmds)
+        for name, res in out.items():
+            if res["rc"] != 0 or res["stderr"].strip() or not res["stdout"].strip():
+                # What can't be read could have changed, do a full backup
+                logger.info("Can't compute backup fingerprint of %s: %s: %s", self._name, name,
+                            res["stderr"].strip() or f"rc={res['rc']}")
+                return None
+        if len(out) != len(cmds):
+            return None
+
+        payload = f"backup_all={self.backup_all}\n{out['files']['stdout']}\n{out['packages']['stdout']}"
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _fingerprint_file(self):
+        return os.path.join(self.app.get_cache_dir('fingerprints'), f"{self._name}.json")
+
+    def last_fingerprint(self):
+        "Return the fingerprint of the last backup"
+
+        # Missing backups must be fetched again
+        if not os.path.isdir(os.path.join(self.path, "config")):
+            return None
+
+        try:
+            with open(self._fingerprint_file(), encoding="utf-8") as _file:
+                return json.load(_file).get("fingerprint")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def cmd_backup(self, list_files=False, force=False):
         "Backup an host"
 
         conn = self.ssh_conn
@@ -194,102 +324,368 @@ class Host:
             return
 
         self.check_git_status()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        metrics = self.app.metrics
 
         # Run state backup
+        state_file = None
+        removed = []
         if self.backup_state:
-            self.cmd_backup_states()
+            with metrics.measure(self._name, "states"):
+                state_file = self.cmd_backup_states()
+                removed = self.remove_legacy_states()
+
+        # Skip unchanged devices
+        fingerprint = None
+        if self.app.settings.get('backup_probe', True):
+            with metrics.measure(self._name, "probe"):
+                fingerprint = self.backup_fingerprint()
+            if not force and fingerprint and fingerprint == self.last_fingerprint():
+                logger.info("No changes on %s since last backup, skip archive", self._name)
+                if self.app.history and (state_file or removed):
+                    with metrics.measure(self._name, "history"):
+                        self.app.history.add_host(self._name, self.path, files=[state_file],
+                                                  deleted=removed)
+                return
+
+        # Create backup directories
+        config_dest = os.path.join(self.path, "config")
+        archive_dir = os.path.join(self.path, "archives")
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
 
-        # Create backup directory
-        if not os.path.isdir(self.path):
-            os.makedirs(self.path)
-        backup_name = os.path.join(self.path, f"backup-{self._name}.tar.gz")
+        file_dest = f"{self._name}-{self.date_now.strftime('%Y%m%d-%H%M%S')}.tar.gz"
+        if self.app.archive_store:
+            file_dest = file_dest.replace(".tar.gz", MANIFEST_EXT)
+        elif self.app.archive_codec == "zstd":
+            file_dest = file_dest.replace(".tar.gz", ZSTD_EXT)
+        archive_file = os.path.join(archive_dir, file_dest)
 
         # Prepare backup command
         logger.info("Start device backup ...")
         bckp_cmd = "sysupgrade -b - -k"
         if self.backup_all:
             bckp_cmd = bckp_cmd + " -o"
-        out = conn(bckp_cmd, _out=backup_name)
 
-        # Decompress backup archive
-        logger.debug("Start backup extraction")
-        tmp_dest = os.path.join(self.path, "config")
-        if not os.path.isdir(tmp_dest):
-            os.makedirs(tmp_dest)
-        sh.tar("-xf", backup_name, "-C", tmp_dest)
+        with trace.span("stream_backup", cat="ssh", host=self._name):
+            digest = self.stream_backup(bckp_cmd, config_dest, archive_file)
+        logger.info("Save backup archive in: %s (sha256: %s)", archive_file, digest)
+
+        if fingerprint:
+            write_json(self._fingerprint_file(), {
+                "fingerprint": fingerprint,
+                "archive": file_dest,
+                "sha256": digest,
+                "date": self.date_now.isoformat(),
+            })
+
+        if self.app.history:
+            with metrics.measure(self._name, "history"):
+                self.app.history.add_host(self._name, self.path,
+                                          files=[state_file, archive_file],
+                                          trees=[config_dest], deleted=removed)
+
+
+    def stream_backup(self, cmd, dest, archive_file):
+        """
+        Run backup command and extract its output while it is received,
+        dest is replaced once the backup succeeded. Compressed data is
+        saved in archive_file, transcoded to zstd, or in the archive
+        store. Return the sha256 of the compressed archive.
+        """
+
+        store = self.app.archive_store
+        splitter = store.splitter() if store else None
+        zstd_mode = not store and archive_file.endswith(ZSTD_EXT)
+        tmp_file = f"{archive_file}.part"
+        tmp_dest = f"{dest}.part"
+        if os.path.isdir(tmp_dest):
+            shutil.rmtree(tmp_dest)
+        os.makedirs(tmp_dest)
+
+        proc = None
+        tee = None
+        start = time.monotonic()
+        read_fd, write_fd = os.pipe()
+        try:
+            # Ssh writes directly in the pipe, our copy must be closed to get EOF
+            with os.fdopen(write_fd, "wb") as pipe_out:
+                proc = self.ssh_conn(cmd, _out=pipe_out, _bg=True, _bg_exc=False,
+                                     _tty_out=False)
+
+            with os.fdopen(read_fd, "rb") as pipe_in, \
+                    open(tmp_file if not store else os.devnull, "wb") as out:
+                if zstd_mode:
+                    splitter = ZstdWriter(out, dictionary=self.app.dictionaries.current(),
+                                          level=self.app.zstd_level)
+                tee = GzipTee(pipe_in, out=None if store or zstd_mode else out, splitter=splitter)
+                with tarfile.open(fileobj=tee, mode="r|") as tar:
+                    logger.debug("Start backup extraction")
+                    tar.extractall(tmp_dest, **TAR_FILTER)
+                tee.drain()
+                if zstd_mode:
+                    splitter.close()
+            proc.wait()
+
+        except BaseException as err:
+            if proc is not None:
+                try:
+                    proc.kill()
+                except Exception: # pylint: disable=broad-except
+                    pass
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            if os.path.isdir(tmp_dest):
+                shutil.rmtree(tmp_dest)
+            self._stream_metrics(start, tee, rc=getattr(err, "exit_code", None) or 1)
+            raise
+
+        self._stream_metrics(start, tee)
+        swap_dir(tmp_dest, dest)
+
+        if store:
+            store.write_manifest(archive_file, splitter,
+                                 gzip_sha256=tee.hexdigest(),
+                                 host=self._name,
+                                 name=os.path.basename(archive_file).replace(MANIFEST_EXT, ".tar.gz"),
+                                 date=self.date_now.isoformat())
+        else:
+            os.replace(tmp_file, archive_file)
+
+        return tee.hexdigest()
+
+    def _stream_metrics(self, start, tee, rc=0):
+        "Split the backup stream time between transfer and extraction"
+
+        total = time.monotonic() - start
+        wait = tee.wait if tee else total
+        metrics = self.app.metrics
+        metrics.add({"host": self._name, "phase": "transfer", "duration": wait,
+                     "bytes": tee.size if tee else 0, "rc": rc})
+        metrics.add({"host": self._name, "phase": "extract", "duration": total - wait})
+
+    def list_archives(self):
+        "Return archives of the host, oldest first"
+
+        path = os.path.join(self.path, "archives")
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if name.endswith((".tar.gz", ZSTD_EXT, MANIFEST_EXT)))
+
+    def restore_archive(self, name, dest=None):
+        """
+        Restore an archive from the store, or copy it when not stored.
+        Stored and zstd archives are restored as their exact tar payload
+        by default, a .tar.gz dest is recompressed.
+        """
+
+        src = os.path.join(self.path, "archives", name)
+        if not os.path.isfile(src):
+            raise error.ArchiveError(f"Unknown archive for {self._name}: {name}")
+
+        if not name.endswith((MANIFEST_EXT, ZSTD_EXT)) or (dest or "").endswith(ZSTD_EXT):
+            dest = dest or name
+            sh.cp(src, dest)
+            return dest
+
+        ext = MANIFEST_EXT if name.endswith(MANIFEST_EXT) else ZSTD_EXT
+        dest = dest or name.replace(ext, ".tar")
+        if dest.endswith(".gz"):
+            logger.warning("Only the tar payload of %s is verified, the gzip layer of %s is "
+                           "recompressed and differs from the original archive", name, dest)
+
+        if ext == ZSTD_EXT:
+            return decompress(src, dest, self.app.dictionaries)
+        return self.app.get_archive_store().restore(src, dest)
+
+    def import_archives(self):
+        "Move existing .tar.gz archives into the store"
+
+        ret = []
+        store = self.app.get_archive_store()
+        for name in self.list_archives():
+            if not name.endswith(".tar.gz"):
+                continue
+            src = os.path.join(self.path, "archives", name)
+            manifest_file = src.replace(".tar.gz", MANIFEST_EXT)
+            manifest = store.ingest(src, manifest_file, host=self._name, name=name)
+
+            # Only drop the original once the store can rebuild it
+            tmp_file = f"{manifest_file}.check.tar"
+            store.restore(manifest_file, tmp_file)
+            os.remove(tmp_file)
+            os.remove(src)
+            ret.append(name)
+            logger.info("Imported archive %s, %s segments", name, len(manifest["segments"]))
+        return ret
 
-        # Save archive
-        tmp_dest = os.path.join(self.path, "archives")
-        file_dest = f"{self._name}-{self.date_now.strftime('%Y%m%d-%H%M%S')}.tar.gz"
-        if not os.path.isdir(tmp_dest):
-            os.makedirs(tmp_dest)
-        tmp_dest = os.path.join(tmp_dest, file_dest)
-        sh.mv(backup_name, tmp_dest)
-        logger.info("Save backup archive in: %s", tmp_dest)
+    def archive_samples(self):
+        "Return files of the last archive, to train zstd dictionaries"
+
+        names = [name for name in self.list_archives() if not name.endswith(MANIFEST_EXT)]
+        if not names:
+            return []
+        src = os.path.join(self.path, "archives", names[-1])
+        with read_tar(src, self.app.dictionaries) as reader:
+            return tar_samples(reader)
+
+    def transcode_archives(self):
+        "Transcode .tar.gz archives, and zstd ones of older dictionaries, with the current dictionary"
+
+        ret = []
+        dictionaries = self.app.dictionaries
+        current = dictionaries.current()
+        current_id = current.dict_id() if current else 0
+        for name in self.list_archives():
+            src = os.path.join(self.path, "archives", name)
+            if name.endswith(ZSTD_EXT):
+                with open(src, "rb") as _file:
+                    if frame_dict_id(_file.read(18)) == current_id:
+                        continue
+            elif not name.endswith(".tar.gz"):
+                continue
 
+            dest = os.path.join(self.path, "archives", name.replace(".tar.gz", ZSTD_EXT))
+            before = os.path.getsize(src)
+            transcode(src, dest, dictionaries, level=self.app.zstd_level)
+            if src != dest:
+                os.remove(src)
+            after = os.path.getsize(dest)
+            logger.info("Transcoded archive %s: %s -> %s bytes", name, before, after)
+            ret.append({"name": os.path.basename(dest), "before": before, "after": after})
+        return ret
 
     def uci_show(self, structured=True, native_type=False):
         "Return uci show on device"
         conn = self.ssh_conn
-        out = conn("uci show")
 
         if structured:
-            return uci2dict(out, native_type=native_type)
-        return str(out)
+            # Parse lines while they arrive, without keeping the whole output
+            with self.app.metrics.measure(self._name, "ssh", command="uci show") as record:
+                lines = conn("uci show", _iter=True, _tty_out=False, _internal_bufsize=1)
 
+                def counted():
+                    for line in lines:
+                        record["bytes"] += len(line)
+                        yield line
 
-    def fw_show(self):
+                return uci2dict(counted(), native_type=native_type)
 
+        out = conn("uci show")
+        return str(out)
 
-        # self.board_target = board_target
-        # self.board_device  =  board_device
-        # self.openwrt_version = openwrt_version
 
-        dl_url_install = f"https://downloads.openwrt.org/releases/{self.openwrt_version}/targets/{self.board_target}/openwrt-{self.openwrt_version}-{self.board_device}-squashfs-factory.bin"
-        dl_url_upgrade = f"https://downloads.openwrt.org/releases/{self.openwrt_version}/targets/{self.board_target}/openwrt-{self.openwrt_version}-{self.board_device}-squashfs-sysupgrade.bin"
+    def drift(self, reference=None):
+        """
+        Return uci changes of the device since its last backup, or against
+        a reference directory of uci files. Only changed packages are fetched.
+        """
 
-        print (dl_url_upgrade, self.app.fw_path)
+        if reference is None:
+            reference = os.path.join(self.path, "config", "etc", "config")
+            if not os.path.isdir(reference):
+                raise error.DriftError(f"No backup found for {self._name}, run backup first")
 
+        remote = parse_md5sums(str(self.ssh_conn(PROBE_CMD, _tty_out=False)))
+        local = tree_of_dir(reference)
+        changed = sorted(pkg for pkg in set(remote) | set(local) if remote.get(pkg) != local.get(pkg))
+        if not changed:
+            return {}
 
-    def fw_download(self, upgrade=True, version=None):
+        fetch = [pkg for pkg in changed if pkg in remote]
+        out = self.ssh_batch({pkg: f"uci show {pkg}" for pkg in fetch}, check=True) if fetch else {}
+        logger.debug("Drift: %s of %s packages differ on %s", len(changed), len(remote), self._name)
 
-        version = version or self.openwrt_version
+        ret = {}
+        for pkg in changed:
+            old = load_package(reference, pkg) if pkg in local else {}
+            new = {}
+            if pkg in remote:
+                new = sections(uci2dict(out[pkg]["stdout"], native_type=False).get(pkg, {}))
+            diff = diff_sections(old, new)
+            if diff:
+                ret[pkg] = diff
+        return ret
 
-        dl_prefix= f"https://downloads.openwrt.org/releases/{version}/targets/{self.board_target}/"
+    def fw_show(self):
+        "Show firmware info, current version comes from cached facts"
+
+        facts = self.get_facts(cached=True) or {}
+        current_version = facts.get("version")
+        version = self.openwrt_version or current_version
+        board_target = self.board_target or facts.get("target")
+
+        dl_prefix = release_url(self.app.fw_mirror, version, board_target)
+        dl_url_install = dl_prefix + image_name(version, self.board_device, "factory")
+        dl_url_upgrade = dl_prefix + image_name(version, self.board_device, "sysupgrade")
+
+        # Image details come from the local firmware index
+        images = {}
+        for image_type in ["factory", "sysupgrade"]:
+            available, info = None, {}
+            if version and board_target and self.board_device:
+                name = image_name(version, self.board_device, image_type)
+                available, info = self.app.fw_index.image(version, board_target, name, size=True)
+            images[image_type] = {
+                "available": available,
+                "size": info.get("size"),
+                "sha256": info.get("sha256"),
+            }
 
-        dl_name= f"openwrt-{version}-{self.board_device}-squashfs-factory.bin"
-        if upgrade:
-            dl_name= f"openwrt-{version}-{self.board_device}-squashfs-sysupgrade.bin"
+        ret = {
+            "version": version,
+            "current_version": current_version,
+            "up_to_date": current_version == version if current_version else None,
+            "url_install": dl_url_install,
+            "url_upgrade": dl_url_upgrade,
+            "images": images,
+            "path": self.app.fw_path,
+        }
+        return ret
 
+
+    def fw_download(self, upgrade=True, version=None):
+
+        facts = {}
+        if not (version or self.openwrt_version) or not self.board_target:
+            facts = self.get_facts(cached=True) or {}
+        version = version or self.openwrt_version or facts.get("version")
+        board_target = self.board_target or facts.get("target")
+        missing = [name for name, value in [("version", version), ("board_target", board_target),
+                                            ("board_device", self.board_device)] if not value]
+        if missing:
+            raise error.DownloadError(
+                f"Can't download firmware of {self._name}, unknown {', '.join(missing)}: "
+                "set it in inventory or run 'facts' first")
+
+        dl_prefix = release_url(self.app.fw_mirror, version, board_target)
+
+        image_type = "sysupgrade" if upgrade else "factory"
+        dl_name = image_name(version, self.board_device, image_type)
         dl_url = f"{dl_prefix}{dl_name}"
 
+        def fetch(dest):
+            available, info = self.app.fw_index.image(version, board_target, dl_name)
+            if available is False:
+                raise error.DownloadError(f"Firmware not available on mirror: {dl_url}")
+            if not info.get("sha256"):
+                logger.warning("No checksum found for %s, download is not verified", dl_name)
+            with self.app.metrics.measure(self._name, "download", url=dl_url) as record:
+                self.app.downloader.download(dl_url, dest, sha256=info.get("sha256"))
+                record["bytes"] = os.path.getsize(dest)
+
+        # Identical images are downloaded once for the whole fleet
+        cache = self.app.fw_cache
+        key = (version, board_target, self.board_device, image_type)
+        cache_file = cache.get(key, fetch)
 
         tmp_dest = os.path.join(self.path, "firmwares")
         if not os.path.isdir(tmp_dest):
             os.makedirs(tmp_dest)
 
-        tmp_dest = os.path.join(tmp_dest, dl_name)
-        dl = Downloader()
-        dl.download(dl_url, tmp_dest)
-        logger.info("Firmware downloaded in %s", tmp_dest)
+        tmp_dest = cache.link(cache_file, os.path.join(tmp_dest, dl_name))
+        logger.info("Firmware available in %s", tmp_dest)
         return tmp_dest
-
-
-
-
-
-class Downloader():
-
-    def download(self, url, dest=None):
-
-        opts = [url]
-        if dest:
-            if os.path.isdir(dest):
-                opts.extend(['-P', dest])
-            else:
-                opts.extend(['-O', dest])
-
-        logger.debug("Downloading url %s", url)
-        sh.wget(*opts)
-
-
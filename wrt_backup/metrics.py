@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from wrt_backup.cache import write_json
+from wrt_backup import trace
+
+
+logger = logging.getLogger(__name__)
+
+PROM_METRICS = [
+    ("phase_duration_seconds", "gauge", "Time spent in a phase during the last run", "duration"),
+    ("phase_bytes", "gauge", "Bytes transferred during a phase", "bytes"),
+    ("phase_calls", "gauge", "Number of times a phase ran", "count"),
+    ("phase_errors", "gauge", "Number of failed phase runs", "errors"),
+]
+
+
+class Metrics:
+    """
+    Per host and per phase measures of a run: duration, bytes transferred
+    and exit status. Phases without host are global to the run.
+    """
+
+    def __init__(self, command=None):
+        self.command = command
+        self.started = time.time()
+        self.records = []
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, host, phase, **labels):
+        "Measure a block, the yielded record can be updated with bytes or rc"
+
+        record = {"host": host, "phase": phase, "bytes": 0, "rc": 0}
+        record.update(labels)
+        start = time.monotonic()
+        try:
+            with trace.span(phase, cat="phase", host=host, **labels):
+                yield record
+        except BaseException as err:
+            record["error"] = type(err).__name__
+            record["rc"] = getattr(err, "exit_code", None) or record["rc"] or 1
+            raise
+        finally:
+            record["duration"] = time.monotonic() - start
+            self.add(record)
+
+    def add(self, record):
+        "Add a measure"
+
+        record.setdefault("bytes", 0)
+        record.setdefault("rc", 0)
+        with self._lock:
+            self.records.append(record)
+
+    def host_done(self, host, duration, error=None):
+        "Record the outcome of a host"
+
+        with self._lock:
+            self.hosts[host] = {
+                "duration": round(duration, 6),
+                "success": error is None,
+                "error": str(error) if error is not None else None,
+            }
+
+    def summary(self):
+        "Return {host: {phase: totals}}, global phases are under the '' host"
+
+        ret = {}
+        for record in self.records:
+            phases = ret.setdefault(record["host"] or "", {})
+            phase = phases.setdefault(record["phase"], {"count": 0, "duration": 0.0,
+                                                        "bytes": 0, "errors": 0})
+            phase["count"] += 1
+            phase["duration"] += record["duration"]
+            phase["bytes"] += record["bytes"]
+            if record["rc"]:
+                phase["errors"] += 1
+        for phases in ret.values():
+            for phase in phases.values():
+                phase["duration"] = round(phase["duration"], 6)
+        return ret
+
+    def report(self):
+        "Return the run report"
+
+        summary = self.summary()
+        slowest = sorted(self.hosts.items(), key=lambda item: -item[1]["duration"])[:10]
+        return {
+            "command": self.command,
+            "started": self.started,
+            "duration": round(time.time() - self.started, 6),
+            "hosts": {
+                name: dict(self.hosts.get(name, {}), phases=summary.get(name, {}))
+                for name in sorted(set(self.hosts) | set(summary)) if name
+            },
+            "run": summary.get("", {}),
+            "slowest_hosts": [name for name, _ in slowest],
+            "records": self.records,
+        }
+
+    def prometheus(self):
+        "Return metrics in Prometheus text format"
+
+        command = _label(self.command or "")
+        lines = []
+        summary = self.summary()
+        for name, kind, doc, key in PROM_METRICS:
+            lines.append(f"# HELP wrt_backup_{name} {doc}")
+            lines.append(f"# TYPE wrt_backup_{name} {kind}")
+            for host, phases in sorted(summary.items()):
+                for phase, values in sorted(phases.items()):
+                    value = round(values[key], 6)
+                    lines.append(f'wrt_backup_{name}{{command="{command}",host="{_label(host)}",'
+                                 f'phase="{_label(phase)}"}} {value}')
+
+        lines.append("# HELP wrt_backup_host_duration_seconds Time spent on a host")
+        lines.append("# TYPE wrt_backup_host_duration_seconds gauge")
+        for host, values in sorted(self.hosts.items()):
+            lines.append(f'wrt_backup_host_duration_seconds{{command="{command}",host="{_label(host)}"}} '
+                         f'{values["duration"]}')
+        lines.append("# HELP wrt_backup_host_success Whether the last run succeeded on a host")
+        lines.append("# TYPE wrt_backup_host_success gauge")
+        for host, values in sorted(self.hosts.items()):
+            lines.append(f'wrt_backup_host_success{{command="{command}",host="{_label(host)}"}} '
+                         f'{int(values["success"])}')
+
+        lines.append("# HELP wrt_backup_run_duration_seconds Duration of the last run")
+        lines.append("# TYPE wrt_backup_run_duration_seconds gauge")
+        lines.append(f'wrt_backup_run_duration_seconds{{command="{command}"}} '
+                     f'{round(time.time() - self.started, 6)}')
+        lines.append("# HELP wrt_backup_run_timestamp_seconds Start time of the last run")
+        lines.append("# TYPE wrt_backup_run_timestamp_seconds gauge")
+        lines.append(f'wrt_backup_run_timestamp_seconds{{command="{command}"}} {round(self.started, 3)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_dir, textfile_dir=None):
+        "Write the JSON report, and the Prometheus textfile when textfile_dir is set"
+
+        if not self.hosts and not self.records:
+            return
+        name = (self.command or "run").replace(' ', '_')
+
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+            path = os.path.join(report_dir, f"{name}.json")
+            write_json(path, self.report())
+            logger.debug("Metrics report written in %s", path)
+
+        if textfile_dir:
+            # The textfile collector must never read a partial file
+            os.makedirs(textfile_dir, exist_ok=True)
+            path = os.path.join(textfile_dir, f"wrt_backup_{name}.prom")
+            tmp_file = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as _file:
+                _file.write(self.prometheus())
+            os.replace(tmp_file, path)
+            logger.debug("Prometheus metrics written in %s", path)
+
+
+def _label(value):
+    "Escape a Prometheus label value"
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
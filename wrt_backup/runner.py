@@ -0,0 +1,76 @@
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from wrt_backup import trace
+
+
+logger = logging.getLogger(__name__)
+
+
+class HostResult:
+    "Outcome of a command run on a single host"
+
+    def __init__(self, host, result=None, error=None, duration=0.0):
+        self.host = host
+        self.result = result
+        self.error = error
+        self.duration = duration
+
+    @property
+    def name(self):
+        "Return host name"
+        return self.host._name
+
+    @property
+    def failed(self):
+        "Return True if the command raised"
+        return self.error is not None
+
+
+def _run_one(host, func, log_msg=None):
+    "Run func on a host and catch its errors"
+
+    if log_msg:
+        logger.info(log_msg.format(hostname=host._name, host=host))
+
+    start = time.monotonic()
+    try:
+        with trace.span(host._name, cat="host"):
+            ret = func(host)
+        return HostResult(host, result=ret, duration=time.monotonic() - start)
+
+    # pylint: disable=broad-except
+    except Exception as err:
+        logger.debug("Host %s failed", host._name, exc_info=True)
+        return HostResult(host, error=err, duration=time.monotonic() - start)
+
+
+def run_hosts(hosts, func, jobs=1, log_msg=None, ordered=True):
+    """
+    Run func(host) on every hosts with up to jobs workers,
+    yield HostResult in hosts order, or as soon as they are done
+    if not ordered
+    """
+
+    hosts = list(hosts)
+    jobs = max(1, min(jobs or 1, len(hosts) or 1))
+
+    # Keep things simple and debuggable when not parallel
+    if jobs == 1:
+        for host in hosts:
+            yield _run_one(host, func, log_msg=log_msg)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="wrt-backup") as pool:
+        futures = [pool.submit(_run_one, host, func, log_msg) for host in hosts]
+        if ordered:
+            for future in futures:
+                yield future.result()
+            return
+
+        # as_completed drops finished futures, so results are released once consumed
+        pending, futures = as_completed(futures), None
+        for future in pending:
+            yield future.result()
@@ -0,0 +1,100 @@
+import re
+import fnmatch
+import logging
+
+import wrt_backup.errors as error
+
+
+logger = logging.getLogger(__name__)
+
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+class HostSelector:
+    """
+    Select inventory hosts from a comma separated list of terms:
+
+        router1        Exact host name
+        router*        Glob on host names
+        @group         Hosts of a group
+        key=value      Hosts with this inventory attribute, value can be a glob
+        !term          Exclude hosts matching term
+
+    Hosts are returned in inventory order. Without positive terms, all
+    hosts are selected before exclusions.
+    """
+
+    def __init__(self, inventory, groups=None):
+        self.names = list(inventory)
+        self.order = {name: idx for idx, name in enumerate(self.names)}
+        self.groups = {}
+        self.attrs = {}
+
+        for name, conf in inventory.items():
+            conf = conf or {}
+            for key, value in conf.items():
+                if key == "groups":
+                    for group in _as_list(value):
+                        self.groups.setdefault(str(group), set()).add(name)
+                elif not isinstance(value, (dict, list)):
+                    self.attrs.setdefault(key, {}).setdefault(str(value), set()).add(name)
+
+        for group, members in (groups or {}).items():
+            hosts = self.groups.setdefault(str(group), set())
+            for member in _as_list(members):
+                if member not in self.order:
+                    raise error.InvalidConfig(f"Unknown host {member} in group {group}")
+                hosts.add(member)
+
+    def match(self, term):
+        "Return the set of host names matching a term"
+
+        if term.startswith('@'):
+            group = term[1:]
+            if group not in self.groups:
+                raise error.InvalidSelector(f"Unknown group: {group}")
+            return self.groups[group]
+
+        if '=' in term:
+            key, _, value = term.partition('=')
+            values = self.attrs.get(key, {})
+            if GLOB_CHARS.search(value):
+                ret = set()
+                for candidate in fnmatch.filter(values, value):
+                    ret |= values[candidate]
+                return ret
+            return values.get(value, set())
+
+        if GLOB_CHARS.search(term):
+            return set(fnmatch.filter(self.names, term))
+
+        if term not in self.order:
+            raise error.InvalidSelector(f"Unknown host: {term}")
+        return {term}
+
+    def select(self, selector):
+        "Return host names matching selector, in inventory order"
+
+        include = set()
+        exclude = set()
+        positive = False
+        for term in re.split(r"[,\s]+", selector or ""):
+            if not term:
+                continue
+            if term.startswith('!'):
+                exclude |= self.match(term[1:])
+            else:
+                positive = True
+                include |= self.match(term)
+
+        if not positive:
+            include = set(self.names)
+        return sorted(include - exclude, key=self.order.__getitem__)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
@@ -0,0 +1,208 @@
+import io
+import os
+import uuid
+import shlex
+import shutil
+import stat
+import tempfile
+import threading
+import logging
+
+from wrt_backup.common import LazyModule
+
+
+sh = LazyModule("sh")
+
+logger = logging.getLogger(__name__)
+
+# Unix sockets paths are limited to 108 chars, and ssh appends
+# a random suffix while creating the socket
+SOCKET_PATH_MAX = 80
+
+
+class SSHMux:
+    "Manage persistent ssh master connections, shared by all hosts of a run"
+
+    def __init__(self, path, persist=60, enabled=True):
+
+        self.enabled = enabled
+        self.persist = persist
+        self.path = path
+        self._shared = False
+        self._private = False
+        self._ready = False
+
+        # Socket names are 40 chars hashes (%C)
+        if len(os.path.join(path, "x" * 40)) > SOCKET_PATH_MAX:
+            self.path = os.path.join(tempfile.gettempdir(), f"wrt-backup-{os.getuid()}")
+            self._shared = True
+            logger.debug("Ssh socket dir is too long, fallback on: %s", self.path)
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._calls = {}
+
+    def ssh_args(self):
+        "Return ssh options to enable connection sharing"
+
+        if not self.enabled:
+            return []
+
+        with self._lock:
+            if not self._ready:
+                self._prepare()
+                self._ready = True
+
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={os.path.join(self.path, '%C')}",
+            "-o", f"ControlPersist={self.persist}",
+        ]
+
+    def _prepare(self):
+        "Create the socket dir, other users must not be able to use it"
+
+        if not self._shared:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            return
+
+        try:
+            os.mkdir(self.path, mode=0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(self.path)
+        if (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+                and not info.st_mode & 0o077):
+            return
+
+        # The shared dir may have been created by another user
+        self.path = tempfile.mkdtemp(prefix=f"wrt-backup-{os.getuid()}-")
+        self._private = True
+        logger.warning("Ssh socket dir %s is not a private dir of the current user, use %s",
+                       os.path.join(tempfile.gettempdir(), f"wrt-backup-{os.getuid()}"), self.path)
+
+    def register(self, host):
+        "Account a new connection use for host, return True on its first use"
+
+        with self._lock:
+            self._hosts[host._name] = host
+            self._calls[host._name] = self._calls.get(host._name, 0) + 1
+            return self._calls[host._name] == 1
+
+    def close(self):
+        "Stop all master connections opened during the run"
+
+        masters = 0
+        saved = 0
+        for name, host in list(self._hosts.items()):
+            if not self.enabled:
+                continue
+            try:
+                host._ssh("-O", "exit", _tty_out=False)
+            except sh.ErrorReturnCode as err:
+                logger.debug("No master connection to close for %s: %s", name, err)
+                continue
+            masters += 1
+            saved += self._calls[name] - 1
+
+        if self._hosts:
+            logger.info("Ssh: %s commands on %s hosts, %s master connections, %s handshakes saved",
+                        sum(self._calls.values()), len(self._hosts), masters, saved)
+
+        self._hosts = {}
+        self._calls = {}
+        if self._private:
+            shutil.rmtree(self.path, ignore_errors=True)
+        return {"masters": masters, "handshakes_saved": saved}
+
+
+# Batched remote commands
+# =================
+
+def batch_script(cmds, delim):
+    """
+    Build a shell script running every commands of cmds dict,
+    with outputs framed by delim markers
+    """
+
+    script = [
+        '_wrtb_err=$(mktemp 2>/dev/null || echo "/tmp/.wrt-backup-err.$$")',
+    ]
+    for name, cmd in cmds.items():
+        assert ' ' not in name, f"Batch command name can't contain spaces: {name}"
+        script.extend([
+            f"printf '%s\\n' {shlex.quote(f'{delim} OUT {name}')}",
+            # Uptime has a centisecond resolution, and works with busybox
+            "read _wrtb_t0 _wrtb_x 2>/dev/null </proc/uptime",
+            "(",
+            cmd,
+            ') 2>"$_wrtb_err" </dev/null',
+            "_wrtb_rc=$?",
+            "read _wrtb_t1 _wrtb_x 2>/dev/null </proc/uptime",
+            f"printf '\\n%s\\n' {shlex.quote(f'{delim} ERR {name}')}",
+            'cat "$_wrtb_err"',
+            f"printf '\\n%s %s %s %s\\n' {shlex.quote(f'{delim} RC {name}')} \"$_wrtb_rc\" \"$_wrtb_t0\" \"$_wrtb_t1\"",
+        ])
+    script.append('rm -f "$_wrtb_err"')
+
+    return '\n'.join(script) + '\n'
+
+
+def parse_batch(lines, delim):
+    """
+    Demultiplex framed batch output lines, return a dict of
+    command names with stdout, stderr, rc and duration when known
+    """
+
+    ret = {}
+    current = None
+    section = None
+    buffer = []
+
+    def flush():
+        # Remove the newline added before each marker
+        out = ''.join(buffer)
+        if out.endswith('\n'):
+            out = out[:-1]
+        return out
+
+    for line in lines:
+        if not line.startswith(delim):
+            buffer.append(line)
+            continue
+
+        parts = line[len(delim):].split()
+        kind, name = parts[0], parts[1]
+
+        if kind == 'OUT':
+            ret[name] = {"stdout": '', "stderr": '', "rc": None}
+        elif kind == 'ERR':
+            ret[name]["stdout"] = flush()
+        elif kind == 'RC':
+            ret[name]["stderr"] = flush()
+            ret[name]["rc"] = int(parts[2])
+            try:
+                ret[name]["duration"] = round(float(parts[4]) - float(parts[3]), 2)
+            except (IndexError, ValueError):
+                pass
+        buffer = []
+        current = name
+        section = kind
+
+    # Partial output of an interrupted command
+    if current and ret[current]["rc"] is None and buffer:
+        target = "stdout" if section == 'OUT' else "stderr"
+        ret[current][target] = ''.join(buffer)
+
+    return ret
+
+
+def run_batch(conn, cmds):
+    "Run a dict of commands in a single ssh call with conn"
+
+    delim = f"--wrt-backup-{uuid.uuid4().hex}--"
+    script = batch_script(cmds, delim)
+    logger.debug("Run %s commands in batch: %s", len(cmds), ', '.join(cmds))
+
+    out = conn("sh", "-s", _in=script, _tty_out=False)
+    return parse_batch(io.StringIO(out, newline='\n'), delim)
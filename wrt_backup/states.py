@@ -0,0 +1,268 @@
+import os
+import json
+import bisect
+import difflib
+import logging
+import datetime
+
+from wrt_backup.common import uci2dict
+from wrt_backup.cache import write_json
+import wrt_backup.errors as error
+
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+FULL_EXT = ".full.json"
+DELTA_EXT = ".delta.json"
+ID_FORMAT = "%Y%m%d-%H%M%S"
+
+
+# Parsers of command outputs
+# ===============================
+
+def parse_os_release(payload):
+    "Parse /etc/os-release"
+
+    ret = {}
+    for line in payload.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            ret[key.strip()] = value.strip().strip('"\'')
+    return ret
+
+
+def parse_df(payload):
+    "Parse df -h output"
+
+    lines = payload.splitlines()
+    if not lines:
+        return []
+    ret = []
+    for line in lines[1:]:
+        fields = line.split(None, 5)
+        if len(fields) == 6:
+            ret.append(dict(zip(["filesystem", "size", "used", "available", "use", "mounted_on"],
+                                fields)))
+    return ret
+
+
+def parse_lines(payload):
+    "Return non empty lines"
+    return [line for line in payload.splitlines() if line.strip()]
+
+
+PARSERS = {
+    "board_cfg": json.loads,
+    "release": parse_os_release,
+    "df": parse_df,
+    "ip_route": parse_lines,
+    "backup_files": parse_lines,
+    "uci_show": uci2dict,
+}
+
+
+def parse_record(name, record):
+    "Return the parsed form of a record stdout, or None"
+
+    parser = PARSERS.get(name)
+    if parser is None or record.get("rc", 0) != 0:
+        return None
+    try:
+        return parser(record["stdout"])
+    # pylint: disable=broad-except
+    except Exception:
+        logger.debug("Can't parse state record %s", name, exc_info=True)
+        return None
+
+
+# Deltas
+# ===============================
+
+def diff_lines(old, new):
+    "Return [start, end, lines] operations turning old into new, lines keep their ends"
+
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [[i1, i2, new_lines[j1:j2]]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def patch_lines(old, ops):
+    "Apply diff_lines operations on old text"
+
+    old_lines = old.splitlines(keepends=True)
+    ret = []
+    pos = 0
+    for start, end, lines in ops:
+        ret.extend(old_lines[pos:start])
+        ret.extend(lines)
+        pos = end
+    ret.extend(old_lines[pos:])
+    return ''.join(ret)
+
+
+def make_delta(old, new):
+    "Return (changes, deleted) of records between two snapshots"
+
+    changes = {}
+    for name, record in new.items():
+        prev = old.get(name)
+        if prev == record:
+            continue
+        change = dict(record)
+        if prev is not None:
+            ops = diff_lines(prev["stdout"], record["stdout"])
+            # Small changes are stored as line patches, others in full
+            if len(json.dumps(ops)) < len(record["stdout"]):
+                del change["stdout"]
+                change["patch"] = ops
+        changes[name] = change
+    deleted = sorted(name for name in old if name not in new)
+    return changes, deleted
+
+
+def apply_delta(records, changes, deleted):
+    "Return records with a delta applied"
+
+    ret = {name: record for name, record in records.items() if name not in deleted}
+    for name, change in changes.items():
+        record = dict(change)
+        if "patch" in record:
+            record["stdout"] = patch_lines(records[name]["stdout"], record.pop("patch"))
+        ret[name] = record
+    return ret
+
+
+# Store
+# ===============================
+
+class StateStore:
+    """
+    Snapshots of host command outputs. Each snapshot is a file, either
+    full (a keyframe) or a delta against the previous snapshot, a new
+    keyframe is written every `keyframe` snapshots to keep reads short.
+    """
+
+    def __init__(self, path, keyframe=20):
+        self.path = path
+        self.keyframe = max(1, keyframe)
+
+    def list(self):
+        "Return snapshots as a sorted list of (id, is_full)"
+
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        ret = []
+        for name in names:
+            if name.endswith(FULL_EXT):
+                ret.append((name[:-len(FULL_EXT)], True))
+            elif name.endswith(DELTA_EXT):
+                ret.append((name[:-len(DELTA_EXT)], False))
+        return sorted(ret)
+
+    def _file(self, snap_id, full):
+        return os.path.join(self.path, snap_id + (FULL_EXT if full else DELTA_EXT))
+
+    def _load(self, snap_id, full):
+        with open(self._file(snap_id, full), encoding="utf-8") as _file:
+            payload = json.load(_file)
+        if payload.get("version") != STATE_VERSION:
+            raise error.StateError(f"Unsupported state snapshot version: {self._file(snap_id, full)}")
+        return payload
+
+    def find(self, at=None):
+        "Return the index of the last snapshot taken at or before at, a date or an id"
+
+        snaps = self.list()
+        if not snaps:
+            return snaps, None
+        if at is None:
+            return snaps, len(snaps) - 1
+
+        if isinstance(at, datetime.datetime):
+            at = at.strftime(ID_FORMAT)
+        ids = [snap_id for snap_id, _ in snaps]
+        idx = bisect.bisect_right(ids, at) - 1
+        return snaps, (idx if idx >= 0 else None)
+
+    def read(self, at=None):
+        "Return (id, records) of a snapshot, or (None, {}) if there is none"
+
+        snaps, idx = self.find(at)
+        if idx is None:
+            return None, {}
+
+        # Replay deltas from the last keyframe
+        start = idx
+        while not snaps[start][1]:
+            start -= 1
+            if start < 0:
+                raise error.StateError(f"No full state snapshot before {snaps[idx][0]} in {self.path}")
+
+        records = {}
+        for snap_id, full in snaps[start:idx + 1]:
+            payload = self._load(snap_id, full)
+            if full:
+                records = payload["records"]
+            else:
+                records = apply_delta(records, payload["records"], payload.get("deleted", []))
+        return snaps[idx][0], records
+
+    def write(self, records, date):
+        "Store a snapshot of records, return its file or None if nothing changed"
+
+        snap_id = date.strftime(ID_FORMAT)
+        snaps = self.list()
+        last_id, last = self.read()
+        if last_id is not None and snap_id <= last_id:
+            logger.warning("State snapshot %s is not newer than %s, skip it", snap_id, last_id)
+            return None
+        if last_id is not None and last == records:
+            logger.info("State unchanged since %s, no snapshot written", last_id)
+            return None
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        payload = {
+            "version": STATE_VERSION,
+            "id": snap_id,
+            "date": date.isoformat(),
+        }
+        since_key = 0
+        for _, full in reversed(snaps):
+            if full:
+                break
+            since_key += 1
+        full = last_id is None or since_key + 1 >= self.keyframe
+        if full:
+            payload["records"] = records
+        else:
+            payload["base"] = last_id
+            payload["records"], payload["deleted"] = make_delta(last, records)
+
+        dest_file = self._file(snap_id, full)
+        write_json(dest_file, payload)
+        return dest_file
+
+    def show(self, at=None, names=None):
+        "Return a snapshot with parsed records"
+
+        snap_id, records = self.read(at)
+        if snap_id is None:
+            raise error.StateError(f"No state snapshot found in {self.path}")
+
+        ret = {}
+        for name, record in records.items():
+            if names and name not in names:
+                continue
+            entry = dict(record)
+            parsed = parse_record(name, record)
+            if parsed is not None:
+                entry["parsed"] = parsed
+            ret[name] = entry
+        return {"id": snap_id, "records": ret}
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+logger = logging.getLogger(__name__)
+
+_NULL = nullcontext()
+_tracer = None
+
+
+class Tracer:
+    """
+    Record spans as Chrome trace events, readable by chrome://tracing
+    or Perfetto. Stacks of all threads can be sampled along.
+    """
+
+    def __init__(self, path, sample_interval=None):
+        self.path = path
+        self.pid = os.getpid()
+        self.events = []
+        self.stack_frames = {}
+        self.samples = []
+        self._frame_ids = {}
+        self._tids = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample_loop, args=(sample_interval,),
+                                             name="wrt-backup-sampler", daemon=True)
+            self._sampler.start()
+
+    def _now(self):
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _tid(self, ident=None, name=None):
+        "Return a small thread id, registered with its name on first use"
+
+        ident = ident or threading.get_ident()
+        tid = self._tids.get(ident)
+        if tid is None:
+            with self._lock:
+                tid = self._tids.setdefault(ident, len(self._tids) + 1)
+            if name is None:
+                name = threading.current_thread().name
+            self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                                "args": {"name": name}})
+        return tid
+
+    @contextmanager
+    def span(self, name, cat, args):
+        "Record the duration of a block"
+
+        tid = self._tid()
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {"name": name, "cat": cat, "ph": "X", "pid": self.pid, "tid": tid,
+                     "ts": round(start, 1), "dur": round(self._now() - start, 1)}
+            if args:
+                event["args"] = {key: str(value) for key, value in args.items()}
+            self.events.append(event)
+
+    def _frame_id(self, frame, parent):
+        key = (frame.f_code, parent)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = self._frame_ids[key] = len(self._frame_ids) + 1
+            code = frame.f_code
+            entry = {"name": f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})",
+                     "category": "python"}
+            if parent:
+                entry["parent"] = parent
+            self.stack_frames[frame_id] = entry
+        return frame_id
+
+    def _sample_loop(self, interval):
+        "Sample the stack of every thread, until stopped"
+
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(interval):
+            ts = round(self._now(), 1)
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            # pylint: disable=protected-access
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame)
+                    frame = frame.f_back
+                parent = None
+                for item in reversed(stack):
+                    parent = self._frame_id(item, parent)
+                tid = self._tid(ident, name=names.get(ident, str(ident)))
+                self.samples.append({"cpu": 0, "tid": tid, "ts": ts, "name": "sample",
+                                     "sf": parent, "weight": 1})
+
+    def write(self):
+        "Stop sampling and write the trace file"
+
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+
+        payload = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+        if self.samples:
+            payload["stackFrames"] = {str(key): value for key, value in self.stack_frames.items()}
+            payload["samples"] = [dict(sample, sf=str(sample["sf"])) for sample in self.samples]
+        with open(self.path, "w", encoding="utf-8") as _file:
+            json.dump(payload, _file)
+        logger.info("Trace written in %s: %s events, %s samples",
+                    self.path, len(self.events), len(self.samples))
+
+
+def start(path, sample_interval=None):
+    "Start tracing the process in path, with stack samples every sample_interval seconds"
+
+    global _tracer  # pylint: disable=global-statement
+    _tracer = Tracer(path, sample_interval=sample_interval)
+    return _tracer
+
+
+def stop():
+    "Stop tracing and write the trace file"
+
+    global _tracer  # pylint: disable=global-statement
+    tracer, _tracer = _tracer, None
+    if tracer:
+        tracer.write()
+
+
+def span(name, cat="wrt_backup", **args):
+    "Return a context manager recording a span, it does nothing when tracing is off"
+
+    if _tracer is None:
+        return _NULL
+    return _tracer.span(name, cat, args)